@@ -0,0 +1,59 @@
+#	benchlib.py
+#
+#	What the benchmark scripts share. Importing it sets up the environment
+#	they run gcwconnect in: the current directory is the root of the tree,
+#	gcwconnect can be imported, and SDL uses its dummy video driver, so that
+#	nothing needs a display. It doesn't import gcwconnect or subprocess
+#	itself, so that scripts can still change what they read when imported.
+
+import os
+import sys
+import time
+
+sys.dont_write_bytecode = True
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(root)
+if root not in sys.path:
+	sys.path.insert(0, root)
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+
+def timings(run, runs, setup=None):
+	'''Times run() runs times, calling setup() untimed before each run, and
+	returns the times taken in seconds, shortest first.'''
+	samples = []
+	for _ in range(runs):
+		if setup is not None:
+			setup()
+		start = time.time()
+		run()
+		samples.append(time.time() - start)
+	samples.sort()
+	return samples
+
+
+def savedconfs(directory, count):
+	'''Writes count saved network configurations to directory, with every
+	kind of encryption in turn.'''
+	encryptions = ('none', 'wep', 'wpa', 'wpa2')
+	for i in range(count):
+		with open(os.path.join(directory, 'network-%05d.conf' % i), 'w') as f:
+			f.write('WLAN_ESSID="network-%05d"\n' % i)
+			f.write('WLAN_PASSPHRASE="passphrase-%d"\n' % i)
+			f.write('WLAN_ENCRYPTION="%s"\n' % encryptions[i % len(encryptions)])
+			f.write('WLAN_DHCP_RETRIES=20\n')
+
+
+def networklist(count):
+	'''A NetworkList of count networks, as NetworksMenu shows them.'''
+	import gcwconnect
+	encryptions = ('none', 'WEP-40', 'WPA', 'WPA2')
+	networks = gcwconnect.NetworkList()
+	for i in range(count):
+		networks.append({
+			'ESSID': 'network-%05d' % i,
+			'Quality': '%d/70' % (i % 71),
+			'Encryption': encryptions[i % len(encryptions)],
+			})
+	return networks
@@ -0,0 +1,90 @@
+#	faketools.py
+#
+#	Stand-ins for the wireless tools gcwconnect runs (iwlist, iwconfig,
+#	ifconfig, ifup, ifdown, rfkill and ap), for the benchmarks. Each one is a
+#	shell script that sleeps for a set latency, prints canned output and exits
+#	with a set status. install() writes them to a directory and puts it first
+#	on PATH, so they are found instead of the real tools.
+#
+#	The latency, output and status of each tool can also be changed between
+#	runs through the environment, which the scripts read every time they run:
+#	    FAKE_<TOOL>_LATENCY   seconds to sleep before printing, e.g. 0.25
+#	    FAKE_<TOOL>_STATUS    exit status
+#	    FAKE_<TOOL>_OUTPUT    file to print instead of the canned output
+
+import os
+import shutil
+import stat
+import tempfile
+
+from iwlistdump import dump
+
+tools = ('iwlist', 'iwconfig', 'ifconfig', 'ifup', 'ifdown', 'rfkill', 'ap')
+
+iwconfig = '''\
+wlan0     IEEE 802.11bgn  ESSID:"network-1"  Nickname:""
+          Mode:Managed  Frequency:2.437 GHz  Access Point: 02:00:00:00:00:01
+          Bit Rate:65 Mb/s   Tx-Power=20 dBm
+          Link Quality=52/70  Signal level=-58 dBm
+'''
+
+ifconfig = '''\
+wlan0     Link encap:Ethernet  HWaddr 02:00:00:00:00:ff
+          inet addr:192.168.1.5  Bcast:192.168.1.255  Mask:255.255.255.0
+          UP BROADCAST RUNNING MULTICAST  MTU:1500  Metric:1
+'''
+
+script = '''#!/bin/sh
+latency=${FAKE_%(var)s_LATENCY:-%(latency)s}
+[ "$latency" = 0 ] || sleep "$latency"
+%(preamble)scat "${FAKE_%(var)s_OUTPUT:-%(output)s}"
+exit ${FAKE_%(var)s_STATUS:-%(status)d}
+'''
+
+
+def install(directory=None, cells=20, latency=None, status=None):
+	'''Writes the stand-ins to directory, or to a new temporary one, and puts
+	it first on PATH. iwlist prints a scan with the given number of cells;
+	ifconfig prints an interface that is up, but only when it is asked about
+	one. latency and status are {tool: value} defaults for the environment
+	variables above. Returns the directory.'''
+	if directory is None:
+		directory = tempfile.mkdtemp(prefix='gcwconnect-tools-')
+	latency = latency or {}
+	status = status or {}
+	outputs = {
+		'iwlist': ''.join(dump(cells)),
+		'iwconfig': iwconfig,
+		'ifconfig': ifconfig,
+		}
+	preambles = {
+		# `ifconfig wlan0 up` prints nothing
+		'ifconfig': '[ $# -gt 1 ] && exit ${FAKE_IFCONFIG_STATUS:-%d}\n' % status.get('ifconfig', 0),
+		}
+	for tool in tools:
+		output = os.path.join(directory, tool + '.out')
+		with open(output, 'w') as f:
+			f.write(outputs.get(tool, ''))
+		path = os.path.join(directory, tool)
+		with open(path, 'w') as f:
+			f.write(script % {
+				'var': tool.upper(),
+				'preamble': preambles.get(tool, ''),
+				'latency': latency.get(tool, 0),
+				'output': output,
+				'status': status.get(tool, 0),
+				})
+		os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+	paths = os.environ.get('PATH', '').split(os.pathsep)
+	if directory not in paths:
+		os.environ['PATH'] = os.pathsep.join([directory] + paths)
+	return directory
+
+
+def uninstall(directory):
+	paths = os.environ.get('PATH', '').split(os.pathsep)
+	if directory in paths:
+		paths.remove(directory)
+		os.environ['PATH'] = os.pathsep.join(paths)
+	shutil.rmtree(directory, ignore_errors=True)
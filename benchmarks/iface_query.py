@@ -0,0 +1,94 @@
+#	iface_query.py
+#
+#	Measures the per-call latency of the interface queries (IPv4 address,
+#	ESSID and link state) against the ifconfig/iwconfig parsing they replace.
+#	The queries are run against the loopback interface and a fake sysfs tree.
+#	Their results are checked by tests/test_ifacequery.py.
+#
+#	Usage: python benchmarks/iface_query.py [calls]
+
+import os
+import shutil
+import subprocess as SU
+import sys
+import tempfile
+
+import benchlib
+import gcwconnect
+
+
+# The queries as they were before, kept here as the baseline.
+
+def legacy_getip(iface):
+	with open(os.devnull, "w") as fnull:
+		output = SU.Popen(['ifconfig', iface],
+				stderr=fnull, stdout=SU.PIPE, close_fds=True).stdout.readlines()
+
+	for line in output:
+		if line.strip().startswith("inet addr"):
+			return str.strip(
+					line[line.find('inet addr')+len('inet addr"') :
+					line.find('Bcast')+len('Bcast')].rstrip('Bcast'))
+
+
+def legacy_getessid(iface):
+	ssid = None
+	with open(os.devnull, "w") as fnull:
+		output = SU.Popen(['iwconfig', iface],
+				stdout=SU.PIPE, stderr=fnull, close_fds=True).stdout.readlines()
+	for line in output:
+		if line.strip().startswith(iface):
+			ssid = str.strip(line[line.find('ESSID')+len('ESSID:"'):line.find(
+				'Nickname:')+len('Nickname:')].rstrip(' Nickname:').rstrip('"'))
+	return ssid
+
+
+def legacy_checkinterfacestatus(iface):
+	return legacy_getip(iface) != None
+
+
+def have(command):
+	return any(os.access(os.path.join(path, command), os.X_OK)
+			for path in os.environ['PATH'].split(os.pathsep))
+
+
+def fakesysfs():
+	'''Creates a sysfs-like tree with a wireless interface that is up and
+	one that is down, and points gcwconnect at it.'''
+	tree = tempfile.mkdtemp()
+	for iface, mac, operstate in (
+			('wlan0', '02:00:00:00:00:01', 'up'),
+			('wlan1', '02:00:00:00:00:02', 'down')):
+		os.mkdir(os.path.join(tree, iface))
+		with open(os.path.join(tree, iface, 'address'), 'w') as f:
+			f.write(mac + '\n')
+		with open(os.path.join(tree, iface, 'operstate'), 'w') as f:
+			f.write(operstate + '\n')
+	gcwconnect.sysfsdir = tree + '/'
+	return tree
+
+
+def bench(query, iface, calls):  # Seconds per call, on average
+	samples = benchlib.timings(lambda: query(iface), calls)
+	return sum(samples) / len(samples)
+
+
+if __name__ == "__main__":
+	calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+	tree = fakesysfs()
+	try:
+		rows = [
+			("IPv4 address", gcwconnect.getip, legacy_getip, 'ifconfig', 'lo'),
+			("ESSID", gcwconnect.getessid, legacy_getessid, 'iwconfig', 'lo'),
+			("link state", gcwconnect.getoperstate, legacy_checkinterfacestatus, 'ifconfig', 'wlan0'),
+			]
+		print("%-14s %14s %14s" % ("query", "legacy us", "native us"))
+		for name, native, legacy, command, iface in rows:
+			after = bench(native, iface, calls) * 1e6
+			if have(command):
+				before = "%14.1f" % (bench(legacy, iface, max(calls // 10, 1)) * 1e6)
+			else:
+				before = "%14s" % ("(no %s)" % command)
+			print("%-14s %s %14.1f" % (name, before, after))
+	finally:
+		shutil.rmtree(tree)
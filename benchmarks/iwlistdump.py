@@ -0,0 +1,55 @@
+#	iwlistdump.py
+#
+#	Synthesizes `iwlist <iface> scan` output for the benchmarks. The layout of
+#	each cell follows what the GCW-Zero's wireless driver prints, including
+#	the multi-line IE blocks and vendor-specific "IE: Unknown" entries.
+
+import sys
+
+
+def cell(i):
+	lines = [
+		"          Cell %02d - Address: 02:00:00:%02X:%02X:%02X" % (i + 1, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff),
+		"                    Channel:%d" % (i % 11 + 1),
+		"                    Frequency:2.%03d GHz (Channel %d)" % (412 + 5 * (i % 11), i % 11 + 1),
+		"                    Quality=%d/70  Signal level=-%d dBm  " % (10 + i % 60, 30 + i % 60),
+		"                    Encryption key:%s" % ("off" if i % 4 == 0 else "on"),
+		'                    ESSID:"network-%d"' % (i % 97),
+		"                    Bit Rates:1 Mb/s; 2 Mb/s; 5.5 Mb/s; 11 Mb/s; 6 Mb/s",
+		"                              9 Mb/s; 12 Mb/s; 18 Mb/s",
+		"                    Bit Rates:24 Mb/s; 36 Mb/s; 48 Mb/s; 54 Mb/s",
+		"                    Mode:Master",
+		"                    Extra:tsf=000000%010x" % i,
+		"                    Extra: Last beacon: %dms ago" % (i % 1000),
+		"                    IE: Unknown: 00%02X6E6574776F726B" % (i % 97),
+		"                    IE: Unknown: 010882848B960C121824",
+		]
+	if i % 4 in (1, 3):
+		lines += [
+			"                    IE: IEEE 802.11i/WPA2 Version 1",
+			"                        Group Cipher : CCMP",
+			"                        Pairwise Ciphers (1) : CCMP",
+			"                        Authentication Suites (1) : PSK",
+			]
+	if i % 4 in (2, 3):
+		lines += [
+			"                    IE: WPA Version 1",
+			"                        Group Cipher : TKIP",
+			"                        Pairwise Ciphers (1) : TKIP",
+			"                        Authentication Suites (1) : PSK",
+			]
+	lines.append("                    IE: Unknown: DD180050F2020101000003A4000027A4000042435E0062322F00")
+	return lines
+
+
+def dump(cells, iface="wlan0"):
+	'''Returns the scan output for the given number of cells as a list of
+	newline-terminated lines, like Popen().stdout.readlines() would.'''
+	lines = ["%-10sScan completed :" % iface]
+	for i in range(cells):
+		lines += cell(i)
+	return [line + "\n" for line in lines]
+
+
+if __name__ == "__main__":
+	sys.stdout.writelines(dump(int(sys.argv[1]) if len(sys.argv) > 1 else 10))
@@ -0,0 +1,83 @@
+#	networks_menu.py
+#
+#	Measures the cost of one move of the selection in the networks menu, for
+#	lists of increasing length, with the row cache and with the draw() that
+#	built a new surface and rendered every visible row on each move. Uses the
+#	SDL dummy video driver, so it runs without a display.
+#
+#	Usage: python benchmarks/networks_menu.py [moves]
+
+import sys
+import time
+
+import benchlib
+import pygame
+import gcwconnect
+gcwconnect.initdisplay()
+
+
+# The draw() as it was before the row cache, kept here as the baseline.
+
+class LegacyNetworksMenu(gcwconnect.NetworksMenu):
+	def draw(self, move=0):
+		if len(self.elements) == 0:
+			return
+
+		if move != 0:
+			self.selected_item += move
+			if self.selected_item < 0:
+				self.selected_item = 0
+			elif self.selected_item >= len(self.elements):
+				self.selected_item = len(self.elements) - 1
+
+		if self.selected_item <= 2:
+			visible_elements = self.elements[0:5]
+			selected_within_visible = self.selected_item
+		elif self.selected_item >= len(self.elements) - 3:
+			visible_elements = self.elements[-5:]
+			selected_within_visible = self.selected_item - (len(self.elements) - len(visible_elements))
+		else:
+			visible_elements = self.elements[self.selected_item - 2:self.selected_item + 3]
+			selected_within_visible = 2
+
+		max_width = 320 - self.origin[0] - 3
+		heights = [self.get_item_height(visible_element) for visible_element in visible_elements]
+		total_height = sum(heights)
+
+		menu_surface = pygame.Surface((max_width, total_height))
+		menu_surface.fill(self.canvas_color)
+
+		top = sum(heights[0:selected_within_visible])
+		pygame.draw.rect(menu_surface, self.selection_color,
+			(0, top, max_width, heights[selected_within_visible]))
+
+		top = 0
+		for i in range(len(visible_elements)):
+			self.render_element(menu_surface, visible_elements[i], 0, top)
+			top += heights[i]
+		gcwconnect.compositor.invalidate(self.dest_surface.blit(menu_surface, self.origin))
+		return self.selected_item
+
+
+def bench(cls, count, moves):
+	menu = cls()
+	menu.move_menu(116, 40)
+	menu.init([], gcwconnect.surface)
+	menu.set_networks(benchlib.networklist(count))
+	menu.selected_item = count // 2
+	menu.draw()
+	# Scroll down and back up, through rows both seen and not seen before
+	start = time.time()
+	for step in [1] * moves + [-1] * moves:
+		menu.draw(step)
+	gcwconnect.compositor.flush()
+	return (time.time() - start) / (2 * moves)
+
+
+if __name__ == "__main__":
+	moves = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+	print("%8s %14s %14s %8s" % ("networks", "legacy us/mv", "cached us/mv", "speedup"))
+	for count in (50, 500, 5000):
+		before = bench(LegacyNetworksMenu, count, min(moves, count // 2 - 3))
+		after = bench(gcwconnect.NetworksMenu, count, min(moves, count // 2 - 3))
+		print("%8d %14.1f %14.1f %7.2fx" % (count, before * 1e6, after * 1e6, before / after))
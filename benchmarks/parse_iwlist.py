@@ -0,0 +1,85 @@
+#	parse_iwlist.py
+#
+#	Measures iwlist scan parsing throughput, in lines per second, for the
+#	streaming parser and for the parsing loop getnetworks() used before it.
+#
+#	Usage: python benchmarks/parse_iwlist.py [repetitions]
+
+import sys
+
+import benchlib
+import gcwconnect
+from iwlistdump import dump
+
+
+# The parser as it was before parseiwlist(), kept here as the baseline.
+
+def legacy_parsemac(macin):
+	mac = str.strip(macin[macin.find("Address:") +
+	                len("Address: "):macin.find("\n")+len("\n")])
+	return mac
+
+
+def legacy_parseessid(essid):
+	essid = str.strip(essid[essid.find('ESSID:"')+len('ESSID:"'):essid.find('"\n')+len('"\n')].rstrip('"\n'))
+	return essid
+
+
+def legacy_parsequality(quality):
+	quality = quality[quality.find(
+	    "Quality=")+len("Quality="):quality.find(" S")+len(" S")].rstrip(" S")
+	if len(quality) < 1:
+		quality = '0/100'
+	return quality
+
+
+def legacy_parseencryption(encryption):
+	encryption = str.strip(encryption)
+
+	if encryption.startswith('Encryption key:off'):
+		encryption = "none"
+	elif encryption.startswith('Encryption key:on'):
+		encryption = "WEP-40"
+	elif encryption.startswith("IE: WPA"):
+		encryption = "WPA"
+	elif encryption.startswith("IE: IEEE 802.11i/WPA2"):
+		encryption = "WPA2"
+	else:
+		encryption = "Encrypted (unknown)"
+	return encryption
+
+
+def legacy(output):
+	networks = {}
+	for item in output:
+		if item.strip().startswith('Cell'):
+			network = networks.setdefault(legacy_parsemac(item), dict())
+
+		elif item.strip().startswith('ESSID:'):
+			network["ESSID"] = (legacy_parseessid(item))
+
+		elif item.strip().startswith('IE:') and not item.strip().startswith('IE: Unknown') or item.strip().startswith('Encryption key:'):
+			network["Encryption"] = (legacy_parseencryption(item))
+
+		elif item.strip().startswith('Quality='):
+			network["Quality"] = (legacy_parsequality(item))
+	return networks
+
+
+def streaming(output):
+	return dict(gcwconnect.parseiwlist(iter(output)))
+
+
+def bench(parse, output, repetitions):  # Lines per second, at best
+	best = benchlib.timings(lambda: parse(output), repetitions)[0]
+	return len(output) / max(best, 1e-9)
+
+
+if __name__ == "__main__":
+	repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+	print("%6s %8s %14s %14s %8s" % ("cells", "lines", "legacy l/s", "stream l/s", "speedup"))
+	for cells in (10, 100, 1000):
+		output = dump(cells)
+		before = bench(legacy, output, repetitions)
+		after = bench(streaming, output, repetitions)
+		print("%6d %8d %14.0f %14.0f %7.2fx" % (cells, len(output), before, after, after / before))
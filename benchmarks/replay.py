@@ -0,0 +1,312 @@
+#	replay.py
+#
+#	Replays input traces into gcwconnect's own main loop and measures, for
+#	every key press, how long it takes until the frame it causes has been
+#	pushed to the display. Reports p50, p95 and max per trace, and exits with
+#	1 if a trace goes over one of its latency budgets. The app runs under the
+#	SDL dummy video driver, with the stand-in wireless tools from faketools.py
+#	and a home directory of its own.
+#
+#	A trace is a text file with one step per line. # starts a comment.
+#	    K_DOWN K_LCTRL           keys pressed in turn, by pygame name
+#	    K_SPACE K_LCTRL * 50     the same, 50 times over
+#	    select <ssid>            the keys that move the selection to a network
+#	                             in the list, worked out from where it is
+#	    type <text>              the keys that type text on the on-screen
+#	                             keyboard, worked out from where its cursor is
+#	    wait <s>                 let the app run for s seconds without input
+#	    saved <count>            start with count saved networks
+#	    cached <count>           start with a scan of count cells in the scan
+#	                             cache, so that the app lists it at launch
+#	    cells <count>            cells in the stand-in iwlist's scan
+#	    latency <tool> <s>       how long the stand-in tool takes
+#	    budget p50|p95|max <ms>  the latency the trace must stay within
+#	The GCW-Zero's buttons are A = K_LCTRL, B = K_LALT, X = K_LSHIFT,
+#	Y = K_SPACE, L = K_TAB, R = K_BACKSPACE, start = K_RETURN and
+#	select = K_ESCAPE. Before each key press, the harness waits for any scan
+#	or connection in progress to finish, as someone holding the device would;
+#	scans in the background, which show nothing, aren't waited for. Once the
+#	trace is over and those have finished too, the app is sent QUIT.
+#
+#	Usage: python benchmarks/replay.py [trace...]
+
+import glob
+import math
+import os
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import benchlib
+import pygame
+from pygame.locals import *
+import gcwconnect
+import faketools
+from iwlistdump import dump
+
+# Nothing should take this long; if it does, the trace is stuck
+timeout = 60
+
+
+class TraceError(Exception):
+	pass
+
+
+class Trace(object):
+	def __init__(self, path):
+		self.steps = []  # Key codes, and ('select', ssid), ('type', text) and ('wait', s)
+		self.saved = 0
+		self.cached = 0
+		self.cells = 20
+		self.latency = {}
+		self.budget = {}
+		with open(path) as f:
+			for number, line in enumerate(f, 1):
+				try:
+					self.parse(line.split('#', 1)[0].split())
+				except (ValueError, IndexError, AttributeError):
+					raise TraceError("%s:%d: can't make sense of %r" % (path, number, line.strip()))
+
+	def parse(self, words):
+		if not words:
+			return
+		if words[0] in ('select', 'type'):
+			self.steps.append((words[0], words[1]))
+		elif words[0] == 'wait':
+			self.steps.append(('wait', float(words[1])))
+		elif words[0] == 'saved':
+			self.saved = int(words[1])
+		elif words[0] == 'cached':
+			self.cached = int(words[1])
+		elif words[0] == 'cells':
+			self.cells = int(words[1])
+		elif words[0] == 'latency':
+			self.latency[words[1]] = float(words[2])
+		elif words[0] == 'budget':
+			if words[1] not in ('p50', 'p95', 'max'):
+				raise ValueError(words[1])
+			self.budget[words[1]] = float(words[2])
+		else:
+			repeat = 1
+			if len(words) > 2 and words[-2] == '*':
+				repeat = int(words[-1])
+				words = words[:-2]
+			if not all(word.startswith('K_') for word in words):
+				raise ValueError(words)
+			self.steps += [getattr(pygame.locals, word) for word in words] * repeat
+
+
+def app():  # The globals of the gcwconnect being run
+	return sys.modules['__main__'].__dict__
+
+
+def selectkey(ssid):
+	'''The next key to press towards selecting a network in the list, or None
+	once it is selected.'''
+	menu = app()['wirelessmenu']
+	names = [element[0] for element in menu.elements] if menu is not None else []
+	if ssid not in names:
+		raise TraceError("%s isn't in the list of networks" % ssid)
+	if names.index(ssid) == menu.selected_item:
+		return None
+	return K_DOWN if names.index(ssid) > menu.selected_item else K_UP
+
+
+def typekey(char):
+	'''The next key to press towards typing char on the on-screen keyboard,
+	and whether it is the one that types it.'''
+	keyboard = app()['Keyboard'].shown
+	if keyboard is None:
+		raise TraceError("nothing to type on: the on-screen keyboard isn't shown")
+	layout = app()['keyLayouts'][keyboard.board]
+	for row, labels in enumerate(layout):
+		if char in labels:
+			column = labels.index(char)
+			break
+	else:
+		return K_SPACE, False  # Y: on to the next layout
+	current_column, current_row = app()['selected_key']
+	if current_row != row:
+		down = (row - current_row) % len(layout) <= len(layout) // 2
+		return (K_DOWN if down else K_UP), False
+	if current_column != column:
+		right = (column - current_column) % len(labels) <= len(labels) // 2
+		return (K_RIGHT if right else K_LEFT), False
+	return K_LCTRL, True
+
+
+def keys(trace):
+	for step in trace.steps:
+		if isinstance(step, tuple) and step[0] == 'select':
+			key = selectkey(step[1])
+			while key is not None:
+				yield key
+				key = selectkey(step[1])
+		elif isinstance(step, tuple) and step[0] == 'wait':
+			yield step
+		elif isinstance(step, tuple):
+			for char in step[1]:
+				typed = False
+				while not typed:
+					key, typed = typekey(char)
+					yield key
+		else:
+			yield step
+
+
+class Replay(object):
+	'''Stands in for pygame.event.wait(), handing the app the keys of a trace
+	whenever it is idle, and for pygame.display.update(), to see when the
+	frame for each key has been pushed.'''
+
+	def __init__(self, trace):
+		self.trace = trace
+		self.keys = keys(trace)
+		self.pressed = None  # When the key waiting for its frame was pressed
+		self.latencies = []  # Seconds, or None for keys that drew nothing
+		self.until = None  # When the wait step being run ends
+		self.over = False
+		self.quit = False
+		self.wait = pygame.event.wait
+		self.update = pygame.display.update
+
+	def install(self):
+		pygame.event.wait = self.nextevent
+		pygame.display.update = self.flushed
+
+	def uninstall(self):
+		pygame.event.wait = self.wait
+		pygame.display.update = self.update
+
+	def busy(self):
+		scanner = app().get('scanner')
+		if scanner is not None and (self.over or not scanner.background):
+			return True
+		return app().get('connector') is not None
+
+	def nextevent(self):
+		if self.quit:
+			raise TraceError("the app was sent QUIT, and kept going")
+		if self.until is not None:
+			# Not wait(), which could sleep well past the end of the step
+			while time.time() < self.until:
+				event = pygame.event.poll()
+				if event.type != NOEVENT:
+					return event
+				time.sleep(0.01)
+			self.until = None
+			self.since = time.time()
+		if self.busy():
+			if time.time() - self.since > timeout:
+				raise TraceError("the app was still busy after %d s" % timeout)
+			return self.wait()
+		if self.pressed is not None:
+			self.latencies.append(None)
+			self.pressed = None
+		if self.over:
+			self.quit = True
+			return pygame.event.Event(QUIT)
+		key = next(self.keys, None)
+		self.since = time.time()
+		if key is None:
+			self.over = True
+			return self.nextevent()
+		if isinstance(key, tuple):  # ('wait', s)
+			self.until = self.since + key[1]
+			return self.nextevent()
+		self.pressed = self.since
+		return pygame.event.Event(KEYDOWN, key=key, mod=0, unicode='')
+
+	def flushed(self, *args):
+		self.update(*args)
+		if self.pressed is not None:
+			self.latencies.append(time.time() - self.pressed)
+			self.pressed = None
+
+	def run(self):
+		self.since = time.time()
+		self.install()
+		try:
+			runpy.run_path('gcwconnect.py', run_name='__main__')
+		except SystemExit:
+			pass
+		finally:
+			self.uninstall()
+		if not self.quit:
+			raise TraceError("the app quit before the trace was over")
+
+
+def replay(trace):
+	home = tempfile.mkdtemp(prefix='gcwconnect-replay-')
+	tools = os.path.join(home, 'tools')
+	os.mkdir(tools)
+	netconfdir = os.path.join(home, '.local', 'share', 'gcwconnect', 'networks')
+	os.makedirs(netconfdir)
+	benchlib.savedconfs(netconfdir, trace.saved)
+	if trace.cached:
+		networks = dict(gcwconnect.parseiwlist(iter(dump(trace.cached))))
+		for network in networks.values():
+			network['Seen'] = time.time()
+		gcwconnect.ScanCache(os.path.join(os.path.dirname(netconfdir), 'scan.cache'),
+			gcwconnect.scanmaxage).save(networks)
+
+	environ = dict(os.environ)
+	Popen = subprocess.Popen
+	class StandinPopen(Popen):
+		# enableiface() runs /sbin/ifconfig by its full path
+		def __init__(self, args, *rest, **kwargs):
+			if args and args[0] == '/sbin/ifconfig':
+				args = ['ifconfig'] + list(args[1:])
+			Popen.__init__(self, args, *rest, **kwargs)
+	try:
+		os.environ['HOME'] = home
+		faketools.install(tools, cells=trace.cells, latency=trace.latency)
+		subprocess.Popen = StandinPopen
+		sys.argv = ['gcwconnect.py']
+		run = Replay(trace)
+		run.run()
+		return run.latencies
+	finally:
+		subprocess.Popen = Popen
+		os.environ.clear()
+		os.environ.update(environ)
+		shutil.rmtree(home, ignore_errors=True)
+
+
+def percentile(samples, p):  # Nearest rank
+	return samples[max(int(math.ceil(p / 100.0 * len(samples))) - 1, 0)]
+
+
+if __name__ == "__main__":
+	paths = sys.argv[1:] or sorted(glob.glob(os.path.join('benchmarks', 'traces', '*.trace')))
+	failed = False
+	print("%-16s %6s %8s %8s %8s %8s  %s" % ("trace", "keys", "no frame", "p50 ms", "p95 ms", "max ms", "budget"))
+	for path in paths:
+		name = os.path.splitext(os.path.basename(path))[0]
+		try:
+			trace = Trace(path)
+			latencies = replay(trace)
+		except TraceError as ex:
+			print("%-16s %s" % (name, ex))
+			failed = True
+			continue
+		drawn = sorted(latency * 1e3 for latency in latencies if latency is not None)
+		if not drawn:
+			print("%-16s no key press drew anything" % name)
+			failed = True
+			continue
+		stats = {
+			'p50': percentile(drawn, 50),
+			'p95': percentile(drawn, 95),
+			'max': drawn[-1],
+			}
+		over = ["%s > %g" % (stat, limit) for stat, limit in sorted(trace.budget.items())
+				if stats[stat] > limit]
+		failed = failed or bool(over)
+		print("%-16s %6d %8d %8.1f %8.1f %8.1f  %s" % (name, len(latencies),
+			len(latencies) - len(drawn), stats['p50'], stats['p95'], stats['max'],
+			"over: " + ", ".join(over) if over else "ok"))
+	sys.exit(1 if failed else 0)
@@ -0,0 +1,40 @@
+#	spawn.py
+#
+#	Measures what it costs to run a tool that does nothing, with SU.Popen()
+#	and close_fds=True as gcwconnect used to, and with its popen(), which
+#	only closes the descriptors that are open. Python 2 closes every one up
+#	to the limit on open files, so the limit is raised as far as it will go
+#	first, as it often is on desktops and in containers. Uses the SDL dummy
+#	video driver, so it runs without a display.
+#
+#	Usage: python benchmarks/spawn.py [runs]
+
+import resource
+import sys
+
+import benchlib
+
+# Before subprocess is imported: it reads the limit then
+soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+if hard != resource.RLIM_INFINITY:
+	resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+import subprocess as SU
+import gcwconnect
+
+
+def bench(run, runs):  # The median, in seconds
+	samples = benchlib.timings(run, runs)
+	return samples[len(samples) // 2]
+
+
+if __name__ == "__main__":
+	runs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+	print("open file limit: %d" % SU.MAXFD)
+	print("%-28s %10s" % ("", "median us"))
+	for label, run in (
+			("SU.Popen(close_fds=True)", lambda: SU.Popen(['true'], close_fds=True).wait()),
+			("SU.Popen(close_fds=False)", lambda: SU.Popen(['true']).wait()),
+			("popen()", lambda: gcwconnect.popen(['true']).wait()),
+			):
+		print("%-28s %10.1f" % (label, bench(run, runs) * 1e6))
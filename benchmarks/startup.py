@@ -0,0 +1,70 @@
+#	startup.py
+#
+#	Measures the time from spawning gcwconnect.py to its first frame being on
+#	screen, as reported on stderr when GCWCONNECT_MEASURE is set. The time for
+#	the interpreter to start and exit on its own is shown as a baseline. Uses
+#	the SDL dummy video driver, so it runs without a display.
+#
+#	Usage: python benchmarks/startup.py [runs] [script]
+
+import os
+import signal
+import subprocess
+import sys
+import time
+
+sys.dont_write_bytecode = True
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(root)
+
+
+def environment():
+	env = dict(os.environ)
+	env.setdefault('SDL_VIDEODRIVER', 'dummy')
+	env['GCWCONNECT_MEASURE'] = '1'
+	env['PYTHONDONTWRITEBYTECODE'] = '1'
+	return env
+
+
+def baseline():
+	start = time.time()
+	subprocess.call([sys.executable, '-c', 'pass'])
+	return time.time() - start
+
+
+def firstframe(script):
+	start = time.time()
+	proc = subprocess.Popen([sys.executable, script], env=environment(),
+		stdout=open(os.devnull, 'w'), stderr=subprocess.PIPE)
+	try:
+		while True:
+			line = proc.stderr.readline()
+			if not line:
+				return None
+			if line.strip() == "first frame":
+				return time.time() - start
+	finally:
+		if proc.poll() is None:
+			os.kill(proc.pid, signal.SIGKILL)
+		proc.wait()
+
+
+def summary(label, samples):
+	samples = sorted(samples)
+	print("%-12s %8.1f %8.1f %8.1f" % (label, samples[0] * 1e3,
+		samples[len(samples) // 2] * 1e3, samples[-1] * 1e3))
+
+
+if __name__ == "__main__":
+	runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+	script = sys.argv[2] if len(sys.argv) > 2 else 'gcwconnect.py'
+
+	interpreter = [baseline() for i in range(runs)]
+	frames = [firstframe(script) for i in range(runs)]
+	if None in frames:
+		sys.exit("%s exited without drawing a frame" % script)
+
+	print("%-12s %8s %8s %8s" % ("ms", "min", "median", "max"))
+	summary("interpreter", interpreter)
+	summary("first frame", frames)
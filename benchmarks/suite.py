@@ -0,0 +1,204 @@
+#	suite.py
+#
+#	Times the hot paths of gcwconnect and writes the results as JSON, so that
+#	they can be compared from one release to the next:
+#	  - ScanWorker.scan(), running a stand-in iwlist and parsing its output
+#	  - parseiwlist(), on its own, on the same output
+#	  - listuniqssids(), on a table of BSSes
+#	  - create_saved_networks_menu(), with the index rebuilt and up to date
+#	  - Menu.draw() and NetworksMenu.draw(), moving the selection
+#	  - drawkeyboard(), the first time a layout is shown and after that
+#
+#	The wireless tools are replaced by the stand-ins from faketools.py, and
+#	the loopback interface stands in for the wireless one: it always has an
+#	address, so nothing tries to bring it up. Uses the SDL dummy video driver,
+#	so it runs without a display. Progress is shown on stderr.
+#
+#	Usage: python benchmarks/suite.py [output.json|- [runs]]
+
+import json
+import os
+import platform
+import shutil
+import subprocess as SU
+import sys
+import tempfile
+import time
+
+import benchlib
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')  # Keep stdout for JSON
+
+import pygame
+import gcwconnect
+import faketools
+from iwlistdump import dump
+
+iface = 'lo'
+
+
+def measure(name, params, run, runs, setup=None):
+	'''Times run() runs times, calling setup() untimed before each run, and
+	returns the result record.'''
+	samples = benchlib.timings(run, runs, setup)
+	record = {
+		'name': name,
+		'params': params,
+		'runs': runs,
+		'min_us': round(samples[0] * 1e6, 1),
+		'median_us': round(samples[len(samples) // 2] * 1e6, 1),
+		'mean_us': round(sum(samples) / len(samples) * 1e6, 1),
+		'max_us': round(samples[-1] * 1e6, 1),
+		}
+	sys.stderr.write("%-28s %-32s %12.1f us\n" % (name,
+		' '.join('%s=%s' % item for item in sorted(params.items())), record['median_us']))
+	return record
+
+
+def bssids(cells):
+	return dict(gcwconnect.parseiwlist(iter(dump(cells))))
+
+
+def bench_scan(runs, tools):
+	results = []
+	for cells in (10, 100):
+		faketools.install(tools, cells=cells)
+		def run():
+			for mac, network in gcwconnect.ScanWorker(iface).scan():
+				pass
+		results.append(measure('ScanWorker.scan', {'cells': cells}, run, runs))
+		lines = list(dump(cells))
+		results.append(measure('parseiwlist', {'cells': cells},
+			lambda: list(gcwconnect.parseiwlist(iter(lines))), runs))
+	return results
+
+
+def bench_listuniqssids(runs):
+	results = []
+	for cells in (20, 200, 2000):
+		gcwconnect.networks = bssids(cells)
+		results.append(measure('listuniqssids', {'bsses': cells},
+			gcwconnect.listuniqssids, runs))
+	return results
+
+
+def bench_saved_networks_menu(runs, directory):
+	results = []
+	for count in (10, 100, 1000):
+		netconfdir = tempfile.mkdtemp(dir=directory) + '/'
+		benchlib.savedconfs(netconfdir, count)
+		# Outside netconfdir, as the app keeps it under confdir: saving it
+		# there would change the directory's mtime and make it stale again
+		index = netconfdir[:-1] + '.index'
+
+		def cold():  # No index yet: every configuration is parsed
+			if os.path.exists(index):
+				os.remove(index)
+			gcwconnect.savednetworks = gcwconnect.SavedNetworks(netconfdir, index)
+		results.append(measure('create_saved_networks_menu',
+			{'confs': count, 'index': 'rebuilt'},
+			gcwconnect.create_saved_networks_menu, runs, cold))
+
+		gcwconnect.create_saved_networks_menu()
+		results.append(measure('create_saved_networks_menu',
+			{'confs': count, 'index': 'current'},
+			gcwconnect.create_saved_networks_menu, runs))
+		gcwconnect.destroy_wireless_menu()
+	return results
+
+
+def bench_menu(runs):
+	menu = gcwconnect.Menu()
+	menu.init(['Saved Networks', 'Scan for APs', 'Manual Setup', 'Create AP', 'Quit'],
+		gcwconnect.surface)
+	moves = [1, 1, 1, 1, -1, -1, -1, -1]
+	def run():
+		menu.draw(moves[run.step % len(moves)])
+		gcwconnect.compositor.flush()
+		run.step += 1
+	run.step = 0
+	return [measure('Menu.draw', {'items': len(menu.elements)}, run, runs)]
+
+
+def bench_networks_menu(runs):
+	results = []
+	for count in (50, 500):
+		menu = gcwconnect.NetworksMenu()
+		menu.move_menu(116, 40)
+		menu.init([], gcwconnect.surface)
+		menu.set_networks(benchlib.networklist(count))
+		menu.draw()
+		# Back and forth over more rows than the row cache holds
+		moves = [1] * 40 + [-1] * 40
+		def run():
+			menu.draw(moves[run.step % len(moves)])
+			gcwconnect.compositor.flush()
+			run.step += 1
+		run.step = 0
+		results.append(measure('NetworksMenu.draw', {'networks': len(menu.elements)}, run, runs))
+	return results
+
+
+def bench_keyboard(runs):
+	results = []
+	for board in ('qwertyNormal', 'wep'):
+		def run():
+			gcwconnect.drawkeyboard(board)
+			gcwconnect.compositor.flush()
+		results.append(measure('drawkeyboard', {'board': board, 'shown': 'first'},
+			run, runs, lambda: gcwconnect.keyboards.clear()))
+		results.append(measure('drawkeyboard', {'board': board, 'shown': 'again'},
+			run, runs))
+	return results
+
+
+def revision():
+	try:
+		with open(os.devnull, 'w') as fnull:
+			return SU.check_output(['git', 'describe', '--always', '--dirty'],
+					stderr=fnull).strip()
+	except (OSError, SU.CalledProcessError):
+		return None
+
+
+if __name__ == "__main__":
+	output = sys.argv[1] if len(sys.argv) > 1 else '-'
+	runs = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+	directory = tempfile.mkdtemp(prefix='gcwconnect-bench-')
+	tools = os.path.join(directory, 'tools')
+	os.mkdir(tools)
+	try:
+		gcwconnect.initdisplay()
+		gcwconnect.logoBar = gcwconnect.LogoBar()
+		gcwconnect.active_menu = 'main'
+		gcwconnect.networks = {}
+		gcwconnect.scancache = gcwconnect.ScanCache(os.path.join(directory, 'scan.cache'),
+			gcwconnect.scanmaxage)
+
+		results = []
+		results += bench_scan(runs, tools)
+		results += bench_listuniqssids(runs)
+		results += bench_saved_networks_menu(runs, directory)
+		results += bench_menu(runs)
+		results += bench_networks_menu(runs)
+		results += bench_keyboard(runs)
+	finally:
+		faketools.uninstall(tools)
+		shutil.rmtree(directory, ignore_errors=True)
+
+	report = {
+		'version': 1,
+		'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+		'revision': revision(),
+		'python': platform.python_version(),
+		'pygame': pygame.version.ver,
+		'machine': platform.machine(),
+		'results': results,
+		}
+	if output == '-':
+		json.dump(report, sys.stdout, indent=1, sort_keys=True)
+		sys.stdout.write('\n')
+	else:
+		with open(output, 'w') as f:
+			json.dump(report, f, indent=1, sort_keys=True)
+			f.write('\n')
@@ -22,26 +22,77 @@
 '''
 
 TODO:
-* Add option to cancel connecting to a network
 * Clean up host ap info display. It's ugly.
 
 '''
 
 
 import subprocess as SU
+import atexit
 import sys
+import socket
+import fcntl
+import struct
+import array
 import time
 import os
 import shutil
-import pygame
-from pygame.locals import *
-import pygame.gfxdraw
+import signal
+import threading
+import bisect
+import heapq
+import select
+import Queue
+import json
 from os import listdir
+from collections import OrderedDict, deque
+from functools import wraps
 from urllib import quote_plus, unquote_plus
 
+# The command line interface (see runcommand()) and --headless have no use
+# for pygame, and importing it is most of the time it takes to start, so they
+# do without it. Any first argument that isn't an option is taken for a
+# command, so that runcommand() rejects the ones it doesn't know rather than
+# the user interface starting.
+tracing = __name__ == "__main__" and '--trace' in sys.argv[1:]  # See Tracer
+if tracing:
+	sys.argv.remove('--trace')
+nodisplay = __name__ == "__main__" and bool(
+		sys.argv[1:2] and not sys.argv[1].startswith('-') or '--headless' in sys.argv[1:])
+if nodisplay:
+	pygame = None
+	USEREVENT = 0  # Only used to number the custom events below
+else:
+	import pygame
+	from pygame.locals import *
+	import pygame.gfxdraw
+
 # What is our wireless interface?
 wlan = "wlan0"
 
+# Connect to the best saved network in range on startup, unless already
+# connected. Can also be asked for with --autojoin; --headless does it
+# without a user interface.
+autojoin = False
+
+# How long, in seconds, networks found by a scan are remembered for
+scanmaxage = 24 * 60 * 60
+
+# How often, in seconds, to scan again while the list of networks is shown.
+# While connected, the interval doubles after every scan up to the maximum.
+# Set scaninterval to 0 to only scan when asked to.
+scaninterval = 20
+scanmaxinterval = 5 * 60
+
+# Networks missed by this many scans in a row are taken off the list
+scanmisses = 3
+
+# How long, in seconds, a tool may run before it is killed, along with
+# everything it has started. Tools that aren't listed get commandtimeout.
+# ifup's time includes getting an address over DHCP.
+commandtimeouts = {'iwlist': 30, 'ifup': 120, 'ifdown': 30, 'ap': 30}
+commandtimeout = 10
+
 # That's it for options. Everything else below shouldn't be edited.
 confdir = os.environ['HOME'] + "/.local/share/gcwconnect/"
 netconfdir = confdir+"networks/"
@@ -76,48 +127,312 @@ colors = {
 mac_addresses = {}
 
 dev_os = "win32"
-if sys.platform == dev_os:
-    DEBUG = True
+DEBUG = sys.platform == dev_os
+
+# The display is opened by initdisplay(), so that importing this module
+# doesn't start SDL.
+screen_width = 320
+screen_height = 240
+surface = None
+
+def initdisplay():
+	'''Starts the display and font subsystems, and on pygame 1.9 nothing else
+	that pygame has to offer, and opens the window.'''
+	global screen_width
+	global screen_height
+	global surface
+	if pygame.version.vernum[0] >= 2:
+		# pygame 2's timers, which the main loop relies on, only work once
+		# pygame.init() has run. pygame 1.9 starts them on first use.
+		pygame.init()
+	else:
+		pygame.display.init()
+		pygame.font.init()
+
+	# What is our screen resolution? SDL's "dummy" video driver, used for
+	# the benchmarks, doesn't report one, so fall back to the GCW-Zero's.
+	infoObject = pygame.display.Info()
+	screen_width = infoObject.current_w or 320
+	screen_height = infoObject.current_h or 240
+	surface = pygame.display.set_mode((screen_width, screen_height))
+
+	surface.fill(colors["darkbg"])
+	pygame.mouse.set_visible(False)
+	pygame.key.set_repeat(199,69) #(delay,interval)
+
+class LazyDict(dict):
+	'''A dict that makes each of its values the first time it is looked up,
+	by calling make(key).'''
+
+	def __init__(self, make):
+		dict.__init__(self)
+		self.make = make
+
+	def __missing__(self, key):
+		value = self[key] = self.make(key)
+		return value
+
+# The files kept under confdir start with a header line, "<magic> <version>"
+# followed by fields of the file's own, and go on with one record per line.
+# Fields are separated by spaces, so any that can hold one must be quoted.
+
+def loadrecords(path, magic, version):
+	'''Reads a file written by saverecords(), and returns the extra fields
+	of its header and the fields of each of its records. Raises IOError if
+	it can't be read and ValueError if it isn't of this magic and version.'''
+	with open(path) as f:
+		header = f.readline().rstrip('\n').split(' ')
+		if header[0] != magic or len(header) < 2 or int(header[1]) != version:
+			raise ValueError(path)
+		return header[2:], [line.rstrip('\n').split(' ') for line in f]
+
+def saverecords(path, magic, version, header, records, what):
+	'''Writes a file for loadrecords(), through a temporary file renamed over
+	it, so that it is never left half written. Failures are reported on
+	stderr as what couldn't be written.'''
+	lines = [' '.join([magic, str(version)] + header) + '\n']
+	lines += [' '.join(fields) + '\n' for fields in records]
+	try:
+		with open(path + '.tmp', 'w') as f:
+			f.writelines(lines)
+		os.rename(path + '.tmp', path)
+	except (IOError, OSError) as ex:
+		sys.stderr.write("Error writing %s: %s\n" % (what, ex))
+
+# Custom events. The main loop sleeps until one of these, or input, arrives.
+STATUSEVENT = USEREVENT + 1		# Time to refresh the interface status
+SCANEVENT = USEREVENT + 2		# The scan worker has published results
+ANIMATEEVENT = USEREVENT + 3	# Time to advance the scan progress animation
+STATSEVENT = USEREVENT + 4		# Time to report loop statistics
+MODALEVENT = USEREVENT + 5		# A modal dialog has timed out
+CONNECTEVENT = USEREVENT + 6	# The connect worker has moved on
+SCANTIMEREVENT = USEREVENT + 7	# Time for the next background scan
+
+def postevent(kind):
+	'''Wakes up the main loop. Safe to call from other threads.'''
+	if pygame is None:
+		return  # There is no main loop to wake up
+	try:
+		pygame.event.post(pygame.event.Event(kind))
+	except pygame.error:
+		pass  # The event queue is full, or the display has been shut down
+
+# Tracing. While it is on, what the functions below decorated with traced()
+# do is recorded as spans, along with the life of every process spawned, and
+# written out as Chrome trace_event JSON on exit or on SIGUSR1, for a trace
+# viewer such as chrome://tracing or Perfetto. It is turned on by setting
+# GCWCONNECT_TRACE to the path to write to, or with --trace, which writes to
+# trace.json under confdir.
+
+class Tracer(object):
+	'''Records spans and instant events into a ring buffer of the last size
+	of them, so that a long session can't run out of memory.'''
+
+	def __init__(self, path, size=16384):
+		self.path = path
+		self.events = deque(maxlen=size)
+		self.threads = {}
+		self.origin = time.time()
+
+	def add(self, name, start, end=None, args=None):  # No end for an instant
+		thread = threading.current_thread()
+		self.threads[thread.ident] = thread.name
+		self.events.append((name, start, end, thread.ident, args))
+
+	def span(self, name):
+		return TracedSpan(self, name)
+
+	def dump(self):
+		# Run at exit, by which time the module's globals may have been torn
+		# down when it was run by runpy
+		import json, os, sys
+		events = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': ident,
+			'args': {'name': name}} for ident, name in self.threads.items()]
+		for name, start, end, ident, args in list(self.events):
+			event = {
+				'name': name,
+				'ph': 'i' if end is None else 'X',
+				'ts': int((start - self.origin) * 1e6),
+				'pid': os.getpid(),
+				'tid': ident,
+				'args': args or {},
+				}
+			if end is None:
+				event['s'] = 't'
+			else:
+				event['dur'] = int((end - start) * 1e6)
+			events.append(event)
+		try:
+			with open(self.path + '.tmp', 'w') as f:
+				json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+			os.rename(self.path + '.tmp', self.path)
+		except (IOError, OSError) as ex:
+			sys.stderr.write("Error writing trace: %s\n" % ex)
+		else:
+			sys.stderr.write("trace: %d events written to %s\n" % (len(events), self.path))
+
+class TracedSpan(object):
+	def __init__(self, tracer, name):
+		self.tracer = tracer
+		self.name = name
 
-pygame.init()
-infoObject = pygame.display.Info()
-surface = pygame.display.set_mode((infoObject.current_w, infoObject.current_h))
+	def __enter__(self):
+		self.start = time.time()
 
-# What is our screen resolution?
-screen_width = infoObject.current_w
-screen_height = infoObject.current_h
+	def __exit__(self, *exc_info):
+		self.tracer.add(self.name, self.start, time.time())
+
+class UntracedSpan(object):
+	def __enter__(self):
+		pass
 
-if not pygame.display.get_init():
-    pygame.display.init()
-if not pygame.font.get_init():
-    pygame.font.init()
+	def __exit__(self, *exc_info):
+		pass
 
-surface.fill(colors["darkbg"])
-pygame.mouse.set_visible(False)
-pygame.key.set_repeat(199,69) #(delay,interval)
+tracer = None
+
+def span(name):  # with span(name): records what runs inside as a span
+	if tracer is None:
+		return UntracedSpan()
+	return tracer.span(name)
+
+def starttracing(path):  # Until exit, when the trace is written
+	global tracer
+	tracer = Tracer(path)
+	atexit.register(tracer.dump)
+	# Handled between events by the main loop, so it can take until the next
+	# one for the trace to be written
+	signal.signal(signal.SIGUSR1, lambda signum, frame: tracer.dump())
+
+def traced(name):  # Decorator: records each call as a span
+	def decorate(function):
+		@wraps(function)
+		def wrapper(*args, **kwargs):
+			if tracer is None:
+				return function(*args, **kwargs)
+			with tracer.span(name):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorate
 
 # Fonts
-font_path = '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
-try:
-    pygame.font.Font(font_path, 10)
-except:
-    font_path = os.environ['HOME'] + \
-        '\\AppData\\Local\\Microsoft\\Windows\\Fonts\\DejaVuSans.ttf'
-font_tiny   = pygame.font.Font(font_path, 8)
-font_small  = pygame.font.Font(font_path, 10)
-font_medium = pygame.font.Font(font_path, 12)
-font_large  = pygame.font.Font(font_path, 16)
-font_huge   = pygame.font.Font(font_path, 48)
-
-font_mono_path = '/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf'
-try:
-    pygame.font.Font(font_mono_path, 10)
-except:
-    font_mono_path = os.environ['HOME'] + \
-        '\\AppData\\Local\\Microsoft\\Windows\\Fonts\\DejaVuSansMono.ttf'
-font_mono_small = pygame.font.Font(font_mono_path, 11)
-
-gcw_font = pygame.font.Font(os.path.join(datadir, 'gcwzero.ttf'), 25)
+class LazyFont(object):
+	'''A font that is only opened the first time it is used, from the first of
+	paths that can be opened. Otherwise it behaves like pygame.font.Font.'''
+
+	renders = 0  # Text rendered with any of them, for the HUD
+
+	def __init__(self, paths, points):
+		self.paths = paths
+		self.points = points
+		self.font = None
+
+	def load(self):
+		for path in self.paths[:-1]:
+			try:
+				return pygame.font.Font(path, self.points)
+			except IOError:
+				pass
+		return pygame.font.Font(self.paths[-1], self.points)
+
+	def __getattr__(self, name):  # Anything that isn't ours is the font's
+		if self.font is None:
+			self.font = self.load()
+		return getattr(self.font, name)
+
+	def render(self, *args):
+		LazyFont.renders += 1
+		return self.__getattr__('render')(*args)
+
+font_path = ('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+	os.environ['HOME'] + '\\AppData\\Local\\Microsoft\\Windows\\Fonts\\DejaVuSans.ttf')
+font_tiny   = LazyFont(font_path, 8)
+font_small  = LazyFont(font_path, 10)
+font_medium = LazyFont(font_path, 12)
+font_large  = LazyFont(font_path, 16)
+font_huge   = LazyFont(font_path, 48)
+
+font_mono_path = ('/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf',
+	os.environ['HOME'] + '\\AppData\\Local\\Microsoft\\Windows\\Fonts\\DejaVuSansMono.ttf')
+font_mono_small = LazyFont(font_mono_path, 11)
+
+gcw_font = LazyFont((os.path.join(datadir, 'gcwzero.ttf'),), 25)
+
+class TextCache(object):
+	'''A bounded LRU cache of rendered text. Most strings on screen are the
+	same from one frame to the next, so rendering them once saves FreeType
+	from doing the same work over and over. Surfaces returned are shared and
+	must not be drawn on.
+	'''
+
+	def __init__(self, size=256):
+		self.size = size
+		self.surfaces = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def render(self, font, text, antialias, color, background=None):
+		key = (font, text, bool(antialias), tuple(color),
+				tuple(background) if background is not None else None)
+		try:
+			rendered = self.surfaces.pop(key)
+			self.hits += 1
+		except KeyError:
+			self.misses += 1
+			if background is None:
+				rendered = font.render(text, antialias, color)
+			else:
+				rendered = font.render(text, antialias, color, background)
+			if len(self.surfaces) >= self.size:
+				self.surfaces.popitem(last=False)
+		self.surfaces[key] = rendered
+		return rendered
+
+	def hitrate(self, hits, misses):  # Since hits and misses were read, as "n%"
+		lookups = self.hits - hits + self.misses - misses
+		if not lookups:
+			return "--%"
+		return "%d%%" % ((self.hits - hits) * 100 / lookups)
+
+textcache = TextCache()
+
+class Compositor(object):
+	'''Collects the areas of the screen drawn on during a frame and pushes
+	only those to the display, in a single update, when the frame is flushed.
+	pushed holds the number of bytes the last flush sent to the display.
+	'''
+
+	def __init__(self):
+		self.dirty = []
+		self.flushes = 0
+		self.pushed = 0
+
+	def invalidate(self, rect=None):
+		if rect is None:
+			rect = surface.get_rect()
+		rect = Rect(rect).clip(surface.get_rect())
+		if rect.width and rect.height:
+			self.dirty.append(rect)
+		return rect
+
+	def flush(self):
+		if not self.dirty:
+			return
+		# Largest first, so areas inside one already being pushed are dropped
+		rects = []
+		for rect in sorted(self.dirty, key=lambda r: r.width * r.height, reverse=True):
+			if not any(r.contains(rect) for r in rects):
+				rects.append(rect)
+		self.dirty = []
+		pygame.display.update(rects)
+		self.flushes += 1
+		self.pushed = sum(r.width * r.height for r in rects) * surface.get_bytesize()
+
+compositor = Compositor()
+
+# Icons, decoded the first time they are drawn, so that drawing a menu after
+# that only has to blit them
+icons = LazyDict(lambda icon: pygame.image.load(os.path.join(datadir, icon)).convert_alpha())
 
 def createpaths():  # Create paths, if necessary
 	if not os.path.exists(confdir):
@@ -129,38 +444,228 @@ def createpaths():  # Create paths, if necessary
 
 # Interface management
 
+# Every tool is run through popen() or call(), so that none of them can hang
+# the device, and so that what they cost can be measured.
+
+class CommandStats(object):
+	'''How many times a tool has been run, how many of those runs failed or
+	timed out, and a histogram of how long they took.'''
+	bounds = (0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30)  # Upper bounds, in seconds
+
+	def __init__(self):
+		self.calls = 0
+		self.failures = 0
+		self.timeouts = 0
+		self.total = 0.0
+		self.histogram = [0] * (len(self.bounds) + 1)  # The last is for longer
+
+	def record(self, seconds, returncode, timedout):
+		self.calls += 1
+		self.failures += returncode != 0
+		self.timeouts += timedout
+		self.total += seconds
+		self.histogram[bisect.bisect_left(self.bounds, seconds)] += 1
+
+	def describe(self):
+		labels = ["<%gms" % (bound * 1000) for bound in self.bounds] + [">%gs" % self.bounds[-1]]
+		return "%d calls, %d failed, %d timed out, mean %.1fms, %s" % (
+			self.calls, self.failures, self.timeouts, self.total / self.calls * 1000,
+			" ".join("%s:%d" % (label, count)
+				for label, count in zip(labels, self.histogram) if count))
+
+commandstats = {}  # Tool name: CommandStats
+
+def reportcommands(stats=commandstats, out=sys.stderr):  # Bound now, for atexit
+	for name, command in sorted(stats.items()):
+		out.write("%s: %s\n" % (name, command.describe()))
+
+class Watchdog(threading.Thread):
+	'''Sends signals to process groups when their time is up. One thread does
+	it for every tool, sleeping in select() until the next deadline, or until
+	a new one wakes it up through a pipe.'''
+
+	def __init__(self):
+		threading.Thread.__init__(self, name='Watchdog')
+		self.daemon = True
+		self.deadlines = []  # A heap of (time, process, signal)
+		self.lock = threading.Lock()
+		self.wakeup, self.waker = os.pipe()
+
+	def watch(self, process, seconds, signum):
+		with self.lock:
+			deadline = (time.time() + seconds, process, signum)
+			heapq.heappush(self.deadlines, deadline)
+			if self.deadlines[0] is deadline:
+				os.write(self.waker, 'w')
+
+	def unwatch(self, process, signum):
+		with self.lock:
+			deadlines = [deadline for deadline in self.deadlines
+				if deadline[1] is not process or deadline[2] != signum]
+			if len(deadlines) != len(self.deadlines):
+				heapq.heapify(deadlines)
+				self.deadlines = deadlines
+
+	def run(self):
+		while True:
+			due = []
+			with self.lock:
+				while self.deadlines and self.deadlines[0][0] <= time.time():
+					due.append(heapq.heappop(self.deadlines))
+				timeout = max(self.deadlines[0][0] - time.time(), 0) if self.deadlines else None
+			for deadline, process, signum in due:
+				if signum == signal.SIGKILL:
+					process.killgroup(signum)
+				elif not process.reaped:
+					process.expire()
+			try:
+				if select.select([self.wakeup], [], [], timeout)[0]:
+					os.read(self.wakeup, 512)
+			except select.error:
+				pass  # Interrupted by a signal
+
+watchdog = None
+
+class Process(SU.Popen):
+	'''A tool started by popen(). It has a process group of its own, so that
+	it can be killed along with everything it has started, and it is once it
+	has run for longer than timeout seconds. When it is reaped, how long it
+	ran for is added to its CommandStats, and to the trace if tracing is on.
+	'''
+	killgrace = 3  # Seconds between SIGTERM and SIGKILL
+
+	def __init__(self, args, timeout, **kwargs):
+		self.argv = args
+		self.name = os.path.basename(args[0])
+		self.timeout = timeout
+		self.timedout = False
+		self.reaped = False
+		self.spawning = time.time()
+		SU.Popen.__init__(self, args, preexec_fn=os.setsid, **kwargs)
+		self.spawned = time.time()
+		watchdog.watch(self, timeout, signal.SIGTERM)
+
+	def _close_fds(self, but):
+		# Runs in the child. Python 2 closes every descriptor up to the limit
+		# on open files, with a system call for each, and the limit can be in
+		# the millions. Only the ones that are open need closing.
+		try:
+			fds = os.listdir('/proc/self/fd')
+		except OSError:
+			return SU.Popen._close_fds(self, but)
+		for fd in map(int, fds):
+			if fd > 2 and fd != but:
+				try:
+					os.close(fd)
+				except OSError:
+					pass  # The one listdir() read the directory with
+
+	def poll(self):
+		returncode = SU.Popen.poll(self)
+		if returncode is not None:
+			self.finished()
+		return returncode
+
+	def wait(self):
+		returncode = SU.Popen.wait(self)
+		self.finished()
+		return returncode
+
+	def finished(self):
+		if self.reaped:
+			return
+		self.reaped = True
+		watchdog.unwatch(self, signal.SIGTERM)
+		now = time.time()
+		commandstats.setdefault(self.name, CommandStats()).record(
+			now - self.spawning, self.returncode, self.timedout)
+		if tracer is not None:
+			tracer.add(self.name, self.spawning, now, {
+				'argv': ' '.join(self.argv),
+				'returncode': self.returncode,
+				'timedout': self.timedout,
+				'spawn_us': int((self.spawned - self.spawning) * 1e6),
+				})
+
+	def expire(self):  # Runs on the watchdog's thread
+		self.timedout = True
+		sys.stderr.write("%s still running after %gs, killing it\n" % (self.name, self.timeout))
+		self.killgroup()
+
+	def killgroup(self, signum=signal.SIGTERM):
+		'''Sends a signal to the process and everything it has started. What
+		is left killgrace seconds after SIGTERM gets SIGKILL.'''
+		if self.reaped and os.path.exists('/proc/%d' % self.pid):
+			# Its pid has been reused. While anything it started is still
+			# running, the pid can't be, as that is their process group.
+			return
+		try:
+			os.killpg(self.pid, signum)
+		except OSError:
+			return  # All gone already
+		if signum == signal.SIGTERM:
+			watchdog.watch(self, self.killgrace, signal.SIGKILL)
+
+spawned = 0  # Processes started, for the HUD
+
+def popen(args, timeout=None, **kwargs):
+	'''Starts a tool, like SU.Popen(), as a Process. Unless another timeout
+	is given, it gets the one in commandtimeouts.'''
+	global spawned, watchdog
+	spawned += 1
+	if watchdog is None:
+		watchdog = Watchdog()
+		watchdog.start()
+	if timeout is None:
+		timeout = commandtimeouts.get(os.path.basename(args[0]), commandtimeout)
+	kwargs.setdefault('close_fds', True)
+	return Process(args, timeout, **kwargs)
+
+def call(args, retries=0, backoff=0.1, **kwargs):
+	'''Runs a tool and returns its exit status. If it fails, it is run again,
+	up to retries more times, backing off from backoff seconds between runs
+	and doubling up to a second.'''
+	for attempt in range(retries + 1):
+		if attempt:
+			time.sleep(min(backoff * 2 ** (attempt - 1), 1))
+		returncode = popen(args, **kwargs).wait()
+		if returncode == 0:
+			break
+	return returncode
+
 
 def ifdown(iface):
     if DEBUG:
         return
     else:
-        SU.Popen(['ifdown', iface], close_fds=True).wait()
-        SU.Popen(['ap', '--stop'], close_fds=True).wait()
+        call(['ifdown', iface])
+        call(['ap', '--stop'])
 
 
 def ifup(iface):
 	if DEBUG:
 		return
-	return SU.Popen(['ifup', iface], close_fds=True).wait() == 0
+	return call(['ifup', iface]) == 0
 
 # Returns False if the interface was previously enabled
 
 
-def enableiface(iface):
+def enableiface(iface, quiet=False):
 	check = checkinterfacestatus(iface)
 	if check:
 		return False
 
-	modal("Enabling WiFi...")
-	drawinterfacestatus()
-	pygame.display.update()
+	if not quiet:
+		modal("Enabling WiFi...")
+		drawinterfacestatus()
+		compositor.flush()
 	if DEBUG:
 		return
-	SU.Popen(['rfkill', 'unblock', 'wlan'], close_fds=True).wait()
-	while True:
-		if SU.Popen(['/sbin/ifconfig', iface, 'up'], close_fds=True).wait() == 0:
-			break
-		time.sleep(0.1);
+	call(['rfkill', 'unblock', 'wlan'])
+	# The interface can take a few seconds to come back once unblocked
+	if call(['/sbin/ifconfig', iface, 'up'], retries=10) != 0:
+		sys.stderr.write("Couldn't bring %s up\n" % iface)
+	invalidatestatus(iface)
 	# Let's grab the MAC address while we're here. If, on redraw, the
 	# interface is disabled, GCW Connect would otherwise be unable to grab it.
 	mac_addresses[iface] = getmac(iface)
@@ -171,21 +676,35 @@ def disableiface():
     if DEBUG:
         return
     else:
-        SU.Popen(['rfkill', 'block', 'wlan'], close_fds=True).wait()
+        call(['rfkill', 'block', 'wlan'])
+        invalidatestatus(wlan)
+
+# Kernel queries. These talk to the kernel directly through ioctls and sysfs
+# rather than forking ifconfig or iwconfig and parsing their output.
+
+sysfsdir = "/sys/class/net/"
+
+SIOCGIFADDR = 0x8915	# <linux/sockios.h>
+SIOCGIWESSID = 0x8B1B	# <linux/wireless.h>
+IW_ESSID_MAX_SIZE = 32
+IFNAMSIZ = 16
+IWREQ_SIZE = 32 # sizeof(struct iwreq): the name plus a 16-byte union
+
 
 def getip(iface):
-    if DEBUG:
-        return "Debug IP"
-    else:
-        with open(os.devnull, "w") as fnull:
-            output = SU.Popen(['/sbin/ifconfig', iface],
-                    stderr=fnull, stdout=SU.PIPE, close_fds=True).stdout.readlines()
+	if DEBUG:
+		return "Debug IP"
 
-    for line in output:
-        if line.strip().startswith("inet addr"):
-            return str.strip(
-                    line[line.find('inet addr')+len('inet addr"') :
-                    line.find('Bcast')+len('Bcast')].rstrip('Bcast'))
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	try:
+		ifreq = fcntl.ioctl(sock.fileno(), SIOCGIFADDR,
+				struct.pack('256s', iface[:IFNAMSIZ - 1]))
+	except IOError:
+		return None  # No IPv4 address, or no such interface
+	finally:
+		sock.close()
+	# struct ifreq: the name, then a sockaddr_in whose address is at offset 4
+	return socket.inet_ntoa(ifreq[IFNAMSIZ + 4:IFNAMSIZ + 8])
 
 
 def getmac(iface):
@@ -193,136 +712,579 @@ def getmac(iface):
         return "Debug MAC"
     else:
         try:
-            with open("/sys/class/net/" + iface + "/address", "rb") as mac_file:
+            with open(sysfsdir + iface + "/address", "rb") as mac_file:
                 return mac_file.readline(17)
         except IOError:
             return None  # WiFi is disabled
 
 
-def getcurrentssid(iface):  # What network are we connected to?
+def getessid(iface):
 	if DEBUG:
 		return "Debug"
-	if not checkinterfacestatus(iface):
+
+	essid = array.array('c', '\0' * (IW_ESSID_MAX_SIZE + 1))
+	address, length = essid.buffer_info()
+	# struct iwreq, with the union holding a struct iw_point
+	iwreq = struct.pack('%dsPHH' % IFNAMSIZ, iface[:IFNAMSIZ - 1], address, length, 0)
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	try:
+		iwreq = fcntl.ioctl(sock.fileno(), SIOCGIWESSID, iwreq.ljust(IWREQ_SIZE, '\0'))
+	except IOError:
+		return None  # Not a wireless interface, or no such interface
+	finally:
+		sock.close()
+	length = struct.unpack('%dsPHH' % IFNAMSIZ,
+			iwreq[:struct.calcsize('%dsPHH' % IFNAMSIZ)])[2]
+	return essid.tostring()[:length].rstrip('\0')
+
+
+def getoperstate(iface):
+	'''Returns the link state of an interface as reported by the kernel
+	("up", "down", "dormant", "unknown"...), or None if it doesn't exist.
+	'''
+	try:
+		with open(sysfsdir + iface + "/operstate") as operstate_file:
+			return operstate_file.read().strip()
+	except IOError:
 		return None
 
-	with open(os.devnull, "w") as fnull:
-		output = SU.Popen(['iwconfig', iface],
-				stdout=SU.PIPE, stderr=fnull, close_fds=True).stdout.readlines()
-	for line in output:
-		if line.strip().startswith(iface):
-			ssid = str.strip(line[line.find('ESSID')+len('ESSID:"'):line.find(
-			    'Nickname:')+len('Nickname:')].rstrip(' Nickname:').rstrip('"'))
-	return ssid
+
+class InterfaceStatus(object):
+	'''A snapshot of the state of a network interface. It is reused until it
+	is older than ttl seconds or has been invalidated by something that
+	changes the state of the interface.
+	'''
+	ttl = 2.0
+
+	def __init__(self, iface):
+		self.iface = iface
+		self.taken = None
+
+	def invalidate(self):
+		self.taken = None
+
+	def refresh(self):
+		if self.taken is not None and time.time() - self.taken < self.ttl:
+			return self
+		self.ip = getip(self.iface)
+		self.up = self.ip is not None
+		self.link = getoperstate(self.iface)
+		self.ssid = getessid(self.iface) if self.up else None
+		self.mac = getmac(self.iface)
+		if self.mac is not None:
+			mac_addresses[self.iface] = self.mac
+		else:
+			self.mac = mac_addresses.get(self.iface)
+		self.taken = time.time()
+		return self
+
+interfaces = {}
+
+def ifacestatus(iface):
+	if iface not in interfaces:
+		interfaces[iface] = InterfaceStatus(iface)
+	return interfaces[iface].refresh()
+
+
+def invalidatestatus(iface):
+	if iface in interfaces:
+		interfaces[iface].invalidate()
+
+
+def getcurrentssid(iface):  # What network are we connected to?
+	if DEBUG:
+		return "Debug"
+	return ifacestatus(iface).ssid
 
 
 def checkinterfacestatus(iface):
-	return getip(iface) != None
+	return ifacestatus(iface).up
 
 
-def connect(iface):  # Connect to a network
-	saved_file = netconfdir + quote_plus(ssid) + ".conf"
-	if os.path.exists(saved_file):
-		shutil.copy2(saved_file, sysconfdir+"config-"+iface+".conf")
+# How long the last scan and the last connection attempt took, in seconds,
+# for the HUD
+durations = {}
 
-	if checkinterfacestatus(iface):
-		disconnect(iface)
+class Worker(threading.Thread):
+	'''Base class for background operations. Results are published to a
+	queue, and the main loop is woken up with the worker's event so that it
+	can drain() them.
+	'''
+	event = None
 
-	modal("Connecting...")
-	if not ifup(wlan):
-		modal('Connection failed!', wait=True)
-		return False
+	def __init__(self):
+		threading.Thread.__init__(self, name=self.__class__.__name__)
+		self.daemon = True
+		self.results = Queue.Queue()
+		self.pending = False
+
+	def publish(self, result):
+		self.results.put(result)
+		# One wakeup is enough for everything queued until drain() runs
+		if not self.pending:
+			self.pending = True
+			postevent(self.event)
+
+	def drain(self):
+		self.pending = False
+		while True:
+			try:
+				yield self.results.get_nowait()
+			except Queue.Empty:
+				return
 
-	modal('Connected!', timeout=True)
-	pygame.display.update()
-	drawstatusbar()
-	drawinterfacestatus()
+
+class ConnectWorker(Worker):
+	'''Connects to a network in the background. It works through the phases
+	below, publishing ('phase', name) as each one starts and ('done',
+	success) at the end. ifup does both association and DHCP, so those two
+	phases are told apart by watching the link state while it runs.
+	'''
+	event = CONNECTEVENT
+	phases = ('ifdown', 'config', 'associate', 'dhcp')
+	labels = {
+		'ifdown': "Disconnecting...",
+		'config': "Staging configuration...",
+		'associate': "Associating...",
+		'dhcp': "Requesting address...",
+		}
+
+	def __init__(self, iface, ssid):
+		Worker.__init__(self)
+		self.iface = iface
+		self.ssid = ssid
+		self.phase = None
+		self.process = None
+		self.cancelled = False
+		self.started = None
+
+	def run(self):
+		self.started = time.time()
+		success = False
+		try:
+			success = self.connect()
+		finally:
+			self.publish(('done', success))
+
+	def enter(self, phase):
+		self.phase = phase
+		if tracer is not None:
+			tracer.add(phase, time.time())
+		self.publish(('phase', phase))
+
+	@traced('ConnectWorker.connect')
+	def connect(self):
+		self.enter('ifdown')
+		if getip(self.iface) is not None:
+			ifdown(self.iface)
+		if self.cancelled:
+			return False
+
+		self.enter('config')
+		saved_file = netconfdir + quote_plus(self.ssid) + ".conf"
+		if os.path.exists(saved_file):
+			shutil.copy2(saved_file, sysconfdir+"config-"+self.iface+".conf")
+		if self.cancelled:
+			return False
+
+		self.enter('associate')
+		if DEBUG:
+			return True
+		# ifup has a process group of its own, so that cancelling also kills
+		# the DHCP client and anything else it has started.
+		self.process = popen(['ifup', self.iface])
+		if self.cancelled:
+			self.cancel()
+		while self.process.poll() is None:
+			if self.phase == 'associate' and getoperstate(self.iface) == 'up':
+				self.enter('dhcp')
+			time.sleep(0.25)
+
+		if self.cancelled:
+			ifdown(self.iface)
+			return False
+		return self.process.returncode == 0
+
+	def cancel(self):
+		self.cancelled = True
+		try:
+			self.process.killgroup()
+		except AttributeError:
+			pass  # Not started yet
+
+
+@traced('connect')
+def connect(iface):  # Connect to a network in the background; see pollconnect()
+	global connector
+	if connector is not None:
+		return False
+	enableiface(iface, quiet=True)
+	connector = ConnectWorker(iface, ssid)
+	connector.dialog = ConnectDialog(connector)
+	openoverlay(connector.dialog)
+	connector.start()
 	return True
 
 
+def pollconnect():
+	global connector
+	for message in connector.drain():
+		if message[0] == 'phase':
+			if overlay is connector.dialog:
+				overlay.draw()
+			continue
+
+		worker, connector = connector, None
+		invalidatestatus(worker.iface)
+		closeoverlay(worker.dialog)
+		if not worker.cancelled:
+			connecthistory.record(worker.ssid, message[1])
+			durations['connect'] = time.time() - worker.started
+		if joiner is not None:
+			pollautojoin(worker, message[1])
+		elif worker.cancelled:
+			pass
+		elif message[1]:
+			openoverlay(Modal('Connected!', timeout=2.5))
+		else:
+			openoverlay(Modal('Connection failed!', [('a', 'Continue')]))
+		redraw()
+		return
+
+
+def pollautojoin(worker, success):  # An auto-join connection attempt has ended
+	global joiner
+	if worker.cancelled:
+		joiner = None
+	elif success:
+		joiner.connected(worker.ssid)
+		joiner = None
+		openoverlay(Modal('Connected!', timeout=2.5))
+	else:
+		joinnext()
+
+
 def disconnect(iface):
 	if checkinterfacestatus(iface):
 		modal("Disconnecting...")
 		ifdown(iface)
+		invalidatestatus(iface)
 
 
-def getnetworks(iface):  # Run iwlist to get a list of networks in range
-	wasnotenabled = enableiface(iface)
-	modal("Scanning...")
+class ScanWorker(Worker):
+	'''Runs iwlist in the background. Each cell is published to the results
+	queue as soon as it has been parsed, followed by a final ('done', None,
+	None) message once the scan has finished or been cancelled.
+	'''
+	event = SCANEVENT
+
+	def __init__(self, iface, background=False):
+		Worker.__init__(self)
+		self.iface = iface
+		self.background = background
+		self.started = time.time()
+		self.found = 0
+		self.cancelled = False
+		self.process = None
+
+	def run(self):
+		try:
+			for mac, network in self.scan():
+				self.found += 1
+				self.publish(('network', mac, network))
+		finally:
+			self.publish(('done', None, None))
+
+	def scan(self):
+		if self.cancelled:
+			return
+		# Inside the generator, so that the span covers the whole scan
+		with span('ScanWorker.scan'), open(os.devnull, "w") as fnull:
+			self.process = popen(['iwlist', self.iface, 'scan'], stdout=SU.PIPE, stderr=fnull)
+			# readline() rather than iterating over stdout, which would
+			# read ahead and hold back cells until its buffer is full.
+			for mac, network in parseiwlist(iter(self.process.stdout.readline, '')):
+				if self.cancelled:
+					break
+				network['Seen'] = time.time()
+				yield mac, network
+			self.process.stdout.close()
+			self.process.wait()
+
+	def cancel(self):
+		self.cancelled = True
+		try:
+			self.process.killgroup()
+		except AttributeError:
+			pass  # Not started yet
+
+
+def startscan(iface, background=False):  # Scan in the background; see pollscan()
+	'''Starts a scan. A background scan is one the user didn't ask for: it
+	shows no progress and can't be cancelled with B. Returns True if the
+	interface had to be enabled for it. The interface is left enabled
+	afterwards, since the user is likely to connect to one of the networks
+	found. Only one scan runs at a time: if the user asks for a scan while a
+	background one is in progress, that one is shown instead.'''
+	global scanner
+	if scanner is not None:
+		if not background:
+			scanner.background = False
+			pygame.time.set_timer(ANIMATEEVENT, 100)
+		return False
+	pygame.time.set_timer(SCANTIMEREVENT, 0)
+	wasnotenabled = enableiface(iface, quiet=background)
 	if DEBUG:
+		return wasnotenabled
+	scanner = ScanWorker(iface, background)
+	scanner.start()
+	if not background:
+		pygame.time.set_timer(ANIMATEEVENT, 100)
+	return wasnotenabled
+
+
+def cancelscan():
+	if scanner is not None:
+		scanner.cancel()
+
+
+scandelay = scaninterval
+
+def schedulescan():  # Arms the timer for the next background scan
+	global scandelay
+	if not scaninterval:
 		return
-	with open(os.devnull, "w") as fnull:
-		output = SU.Popen(['iwlist', iface, 'scan'],
-				stdout=SU.PIPE, stderr=fnull, close_fds=True).stdout.readlines()
-	for item in output:
-		if item.strip().startswith('Cell'):
-			# network is the current list corresponding to a MAC address {MAC:[]}
-			network = networks.setdefault(parsemac(item), dict())
-
-		elif item.strip().startswith('ESSID:'):
-			network["ESSID"] = (parseessid(item))
-
-		elif item.strip().startswith('IE:') and not item.strip().startswith('IE: Unknown') or item.strip().startswith('Encryption key:'):
-			network["Encryption"] = (parseencryption(item))
-
-		elif item.strip().startswith('Quality='):
-			network["Quality"] = (parsequality(item))
-		# Now the loop is over, we will probably find a MAC address and a new "network" will be created.
-	redraw()
+	if ifacestatus(wlan).ip is not None:
+		# Scanning can get in the way of the connection, so back off
+		scandelay = min(scandelay * 2, scanmaxinterval)
+	else:
+		scandelay = scaninterval
+	pygame.time.set_timer(SCANTIMEREVENT, int(scandelay * 1000))
 
-	if wasnotenabled:
-		disableiface(iface)
-	return networks
 
+def unschedulescan():
+	pygame.time.set_timer(SCANTIMEREVENT, 0)
 
-def listuniqssids():
-	menuposition = 0
-	uniqssid = {}
-	uniqssids = {}
 
-	for network, detail in networks.iteritems():
-		if detail['ESSID'] not in uniqssids and detail['ESSID']:
-			uniqssid = uniqssids.setdefault(detail['ESSID'], detail)
-			uniqssid["menu"] = menuposition
-			uniqssid["Encryption"] = detail['Encryption']
-			menuposition += 1
-	return uniqssids
+scanfields = ('ESSID', 'Quality', 'Encryption', 'Channel')
 
-# Parsing iwlist output for various components
+def pollscan():
+	'''Drains the results published by the scan worker into the networks
+	table, and returns the ESSIDs of the networks that were added, changed
+	or removed. Once a scan has run to completion, the networks it missed
+	scanmisses times in a row are expired.
+	'''
+	global scanner
+	changed = set()
+	finished = False
+	for kind, mac, network in scanner.drain():
+		if kind == 'network':
+			known = networks.get(mac)
+			if known is None:
+				networks[mac] = known = {}
+				changed.add(network.get('ESSID'))
+			elif known.get('Missed') or any(known.get(field) != network.get(field) for field in scanfields):
+				changed.add(known.get('ESSID'))
+				changed.add(network.get('ESSID'))
+			known.update(network)
+			known['Missed'] = 0
+		else:
+			finished = True
+
+	if finished:
+		pygame.time.set_timer(ANIMATEEVENT, 0)
+		if not scanner.cancelled:
+			durations['scan'] = time.time() - scanner.started
+			for mac, network in networks.items():
+				if network.get('Seen', 0) < scanner.started:
+					network['Missed'] = network.get('Missed', 0) + 1
+					if network['Missed'] >= scanmisses:
+						del networks[mac]
+					changed.add(network.get('ESSID'))
+		scanner = None
+		scancache.save(networks)
+	changed.discard(None)
+	return changed
+
+
+class ScanCache(object):
+	'''The networks found by previous scans, kept in a file under confdir so
+	that they can be listed straight away while a new scan runs. Networks
+	that have not been seen for maxage seconds are dropped.
+
+	The cache is a header line followed by one line per BSS, with every
+	field but the time it was last seen quoted with quote_plus():
+	    gcwconnect-scan <version>
+	    <MAC> <seen> <ESSID> <quality> <encryption> <channel>
+	'''
+	version = 1
+	fields = ('ESSID', 'Quality', 'Encryption', 'Channel')
 
+	def __init__(self, path, maxage):
+		self.path = path
+		self.maxage = maxage
 
-def parsemac(macin):
-	mac = str.strip(macin[macin.find("Address:") +
-	                len("Address: "):macin.find("\n")+len("\n")])
-	return mac
+	def load(self):  # Returns {MAC: network} for the networks still current
+		networks = {}
+		oldest = time.time() - self.maxage
+		try:
+			header, records = loadrecords(self.path, 'gcwconnect-scan', self.version)
+			for mac, seen, essid, quality, encryption, channel in records:
+				if float(seen) < oldest:
+					continue
+				networks[unquote_plus(mac)] = {
+					'Seen': float(seen),
+					'Missed': 1,
+					'ESSID': unquote_plus(essid),
+					'Quality': unquote_plus(quality),
+					'Encryption': unquote_plus(encryption),
+					'Channel': unquote_plus(channel),
+					}
+		except (IOError, ValueError):
+			return {}
+		return networks
+
+	def save(self, networks):
+		oldest = time.time() - self.maxage
+		records = [[quote_plus(mac), repr(network['Seen'])] +
+				[quote_plus(str(network.get(field, ''))) for field in self.fields]
+			for mac, network in sorted(networks.iteritems())
+			if network.get('Seen', 0) >= oldest and network.get('ESSID')]
+		saverecords(self.path, 'gcwconnect-scan', self.version, [], records, 'scan cache')
+
+scancache = ScanCache(confdir + "scan.cache", scanmaxage)
+
+
+class NetworkList(object):
+	'''The networks shown in a NetworksMenu, in menu order. Records are
+	looked up by menu position or by ESSID in constant time.
+	'''
+	def __init__(self):
+		self.records = []
+		self.byssid = {}
+		self.positions = {}
 
+	def append(self, detail):
+		self.positions[detail['ESSID']] = len(self.records)
+		self.records.append(detail)
+		self.byssid[detail['ESSID']] = detail
 
-def parseessid(essid):
-	essid = str.strip(essid[essid.find('ESSID:"')+len('ESSID:"'):essid.find('"\n')+len('"\n')].rstrip('"\n'))
-	return essid
+	def index(self, ssid):
+		return self.positions[ssid]
 
+	def get(self, ssid, default=None):
+		return self.byssid.get(ssid, default)
 
-def parsequality(quality):
-	quality = quality[quality.find(
-	    "Quality=")+len("Quality="):quality.find(" S")+len(" S")].rstrip(" S")
-	if len(quality) < 1:
-		quality = '0/100'
-	return quality
+	def __getitem__(self, position):
+		return self.records[position]
 
+	def __contains__(self, ssid):
+		return ssid in self.byssid
 
-def parseencryption(encryption):
-	encryption = str.strip(encryption)
+	def __iter__(self):
+		return iter(self.records)
 
-	if encryption.startswith('Encryption key:off'):
-	 	encryption = "none"
-	elif encryption.startswith('Encryption key:on'):
-		encryption = "WEP-40"
-	elif encryption.startswith("IE: WPA"):
-		encryption = "WPA"
-	elif encryption.startswith("IE: IEEE 802.11i/WPA2"):
-		encryption = "WPA2"
-	else:
-		encryption = "Encrypted (unknown)"
-	return encryption
+	def __len__(self):
+		return len(self.records)
+
+def qualityfraction(quality):  # Signal quality, '37/70' -> 0.53
+	try:
+		current, maximum = quality.split('/')
+		return min(float(current) / float(maximum), 1.0)
+	except (AttributeError, ValueError, ZeroDivisionError):
+		return 0.0
+
+def listuniqssids():
+	'''Groups the BSS table in `networks` by ESSID. Each SSID is represented
+	by its strongest BSS, with every BSS seen for it kept under 'BSSIDs' as
+	(MAC, network) tuples, strongest first. The list is sorted by signal.
+	In both orders, BSSes missed by the latest scan come last, as their
+	signal is out of date.
+	'''
+	groups = {}
+	for mac, detail in networks.iteritems():
+		if detail.get('ESSID'):
+			groups.setdefault(detail['ESSID'], []).append(
+				(not detail.get('Missed'), qualityfraction(detail.get('Quality')), mac, detail))
+
+	records = []
+	for essid, bsses in groups.iteritems():
+		bsses.sort(reverse=True)
+		fresh, signal, mac, best = bsses[0]
+		record = dict(best)
+		record.setdefault('Quality', '0/1')
+		record.setdefault('Encryption', '')
+		record['BSSID'] = mac
+		record['BSSIDs'] = [bss[2:] for bss in bsses]
+		record['Seen'] = max(bss[3].get('Seen', 0) for bss in bsses)
+		records.append((fresh, signal, essid, record))
+	records.sort(key=lambda r: (not r[0], -r[1], r[2]))
+
+	uniqssids = NetworkList()
+	for fresh, signal, essid, record in records:
+		uniqssids.append(record)
+	return uniqssids
+
+def agelabel(seconds):  # 'n ago', in the largest unit that fits
+	for unit, length in (('d', 86400), ('h', 3600), ('m', 60)):
+		if seconds >= length:
+			return "%d%s ago" % (seconds // length, unit)
+	return "%ds ago" % max(seconds, 0)
+
+# Parsing iwlist output
+
+def parseiwlist(lines):
+	'''Streaming parser for the output of `iwlist <iface> scan`. Consumes lines
+	as they arrive and yields a (MAC, network) tuple for each cell as soon as
+	the next one starts, or when the output ends.
+	'''
+	mac = None
+	network = None
+	for line in lines:
+		line = line.strip()
+		if line.startswith('Cell '):
+			if mac is not None:
+				yield mac, finishcell(network)
+			mac = line[line.find('Address:') + len('Address:'):].strip()
+			network = {'IE': []}
+		elif mac is None:
+			continue
+		elif line.startswith('ESSID:'):
+			essid = line[len('ESSID:'):]
+			if len(essid) >= 2 and essid[0] == '"' and essid[-1] == '"':
+				essid = essid[1:-1]
+			network['ESSID'] = essid
+		elif line.startswith('Quality='):
+			quality = line[len('Quality='):].split(' ', 1)[0]
+			network['Quality'] = quality or '0/100'
+		elif line.startswith('Encryption key:'):
+			network['Key'] = line[len('Encryption key:'):]
+		elif line.startswith('IE: '):
+			if not line.startswith('IE: Unknown'):
+				network['IE'].append(line[len('IE: '):])
+		elif line.startswith('Channel:'):
+			network['Channel'] = line[len('Channel:'):]
+	if mac is not None:
+		yield mac, finishcell(network)
+
+
+def finishcell(network):
+	'''Works out the encryption of a cell from its key flag and all of its
+	information elements, preferring the strongest method advertised.
+	'''
+	ies = network.pop('IE')
+	key = network.pop('Key', None)
+	if any(ie.startswith('IEEE 802.11i/WPA2') for ie in ies):
+		network['Encryption'] = "WPA2"
+	elif any(ie.startswith('WPA') for ie in ies):
+		network['Encryption'] = "WPA"
+	elif key == 'off':
+		network['Encryption'] = "none"
+	elif key == 'on':
+		network['Encryption'] = "WEP-40"
+	elif ies:
+		network['Encryption'] = "Encrypted (unknown)"
+	return network
 
 
 def aafilledcircle(surface, color, center, radius):
@@ -360,7 +1322,7 @@ class hint:
 
 			button = pygame.draw.rect(
 			    surface, colors["black"], (self.x, self.y, 15, 11))
-			text = font_tiny.render(self.button.upper(), True,
+			text = textcache.render(font_tiny, self.button.upper(), True,
 			                        colors["white"], colors["black"])
 			buttontext = text.get_rect()
 			buttontext.center = button.center
@@ -381,7 +1343,7 @@ class hint:
 			if self.button == 'start':
 				roundedbox.bottomleft = lbox.midbottom
 			pygame.draw.rect(surface, colors["black"], roundedbox)
-			text = font_tiny.render(self.button.upper(), True,
+			text = textcache.render(font_tiny, self.button.upper(), True,
 			                        colors["white"], colors["black"])
 			buttontext = text.get_rect()
 			buttontext.center = buttoncenter
@@ -389,7 +1351,7 @@ class hint:
 			surface.blit(text, buttontext)
 
 			labelblock = pygame.draw.rect(surface, self.bg, (self.x+40, self.y, 25, 14))
-			labeltext = font_tiny.render(self.text, True, colors["white"], self.bg)
+			labeltext = textcache.render(font_tiny, self.text, True, colors["white"], self.bg)
 			surface.blit(labeltext, labelblock)
 
 		elif self.button in ('a', 'b', 'x', 'y'):
@@ -403,11 +1365,11 @@ class hint:
 				color = colors["yellow"]
 
 			labelblock = pygame.draw.rect(surface, self.bg, (self.x+10, self.y, 35, 14))
-			labeltext = font_tiny.render(self.text, True, colors["white"], self.bg)
+			labeltext = textcache.render(font_tiny, self.text, True, colors["white"], self.bg)
 			surface.blit(labeltext, labelblock)
 
 			button = aafilledcircle(surface, color, (self.x, self.y+5), 6)  # (x, y)
-			text = font_tiny.render(self.button.upper(), True, colors["white"], color)
+			text = textcache.render(font_tiny, self.button.upper(), True, colors["white"], color)
 			buttontext = text.get_rect()
 			buttontext.center = button.center
 			surface.blit(text, buttontext)
@@ -432,7 +1394,7 @@ class hint:
 				pygame.draw.rect(surface, colors["white"], (self.x+6, self.y+7, 2, 3))
 
 			labelblock = pygame.draw.rect(surface, self.bg, (self.x+20, self.y, 35, 14))
-			labeltext = font_tiny.render(self.text, True, (255, 255, 255), self.bg)
+			labeltext = textcache.render(font_tiny, self.text, True, (255, 255, 255), self.bg)
 			surface.blit(labeltext, labelblock)
 
 
@@ -456,6 +1418,7 @@ class LogoBar(object):
 		rect2 = self.text2.get_rect()
 		rect2.topleft = rect1.topright
 		surface.blit(self.text2, rect2)
+		compositor.invalidate((0, 0, screen_width, 35))
 
 
 def drawstatusbar():  # Set up the status bar
@@ -464,40 +1427,66 @@ def drawstatusbar():  # Set up the status bar
 	                 (0, screen_height - 16, screen_width, 16))
 	pygame.draw.line(
 		surface, colors['white'], (0, screen_height - 17), (screen_width, screen_height - 17))
-	wlantext = font_mono_small.render(
+	wlantext = textcache.render(font_mono_small,
 		"...", True, colors['white'], colors['lightbg'])
 	wlan_text = wlantext.get_rect()
 	wlan_text.topleft = (2, screen_height - 16)
 	surface.blit(wlantext, wlan_text)
+	compositor.invalidate((0, screen_height - 17, screen_width, 17))
 
 def drawinterfacestatus(): # Interface status badge
 	global colors
-	wlanstatus = checkinterfacestatus(wlan)
-	if not wlanstatus:
+	compositor.invalidate((0, screen_height - 16, screen_width, 16))
+	status = ifacestatus(wlan)
+	if not status.up:
 		wlanstatus = wlan+" is off."
 	else:
-		wlanstatus = getcurrentssid(wlan)
+		wlanstatus = status.ssid or ""
 
-	wlantext = font_mono_small.render(wlanstatus, True, colors['white'], colors['lightbg'])
+	wlantext = textcache.render(font_mono_small, wlanstatus, True, colors['white'], colors['lightbg'])
 	wlan_text = wlantext.get_rect()
 	wlan_text.topleft = (2, screen_height - 15)
 	surface.blit(wlantext, wlan_text)
 
 	# Note that the leading space here is intentional, to more cleanly overdraw any overly-long
 	# strings written to the screen beneath it (i.e. a very long ESSID)
-	if checkinterfacestatus(wlan):
-		text = font_mono_small.render(" "+getip(wlan), True, colors['white'], colors['lightbg'])
+	if status.up:
+		text = textcache.render(font_mono_small, " "+status.ip, True, colors['white'], colors['lightbg'])
 		interfacestatus_text = text.get_rect()
 		interfacestatus_text.topright = (screen_width - 3, screen_height - 15)
 		surface.blit(text, interfacestatus_text)
 	else:
-		mac = mac_addresses.get(wlan)  # grabbed by enableiface()
+		mac = status.mac
 		if mac is not None:
-			text = font_mono_small.render(" "+mac, True, colors['white'], colors['lightbg'])
+			text = textcache.render(font_mono_small, " "+mac, True, colors['white'], colors['lightbg'])
 			interfacestatus_text = text.get_rect()
 			interfacestatus_text.topright = (screen_width - 3, screen_height - 15)
 			surface.blit(text, interfacestatus_text)
 
+def drawscanprogress(): # Scan progress, drawn over the interface status
+	global colors
+	compositor.invalidate(pygame.draw.rect(surface, colors['lightbg'],
+	                 (0, screen_height - 16, screen_width, 16)))
+
+	text = textcache.render(font_mono_small,
+		"Scanning... %d" % scanner.found, True, colors['white'], colors['lightbg'])
+	scan_text = text.get_rect()
+	scan_text.topleft = (2, screen_height - 15)
+	surface.blit(text, scan_text)
+
+	hint("b", "Cancel", 160, screen_height - 13, colors['lightbg'])
+
+	# The duration of a scan is unknown, so sweep a block back and forth.
+	bar = pygame.Rect(screen_width - 83, screen_height - 12, 80, 8)
+	pygame.draw.rect(surface, colors['white'], bar, 1)
+	travel = bar.width - 18
+	step = int((time.time() - scanner.started) * 40) % (travel * 2)
+	if step > travel:
+		step = travel * 2 - step
+	pygame.draw.rect(surface, colors['activeselbg'],
+	                 (bar.x + 2 + step, bar.y + 2, 14, bar.height - 4))
+
+@traced('redraw')
 def redraw():
 	global colors
 	surface.fill(colors['darkbg'])
@@ -517,56 +1506,167 @@ def redraw():
 		hint("y", "Forget", 195, screen_height - 30)
 
 	drawstatusbar()
-	drawinterfacestatus()
-	pygame.display.update()
+	if scanner is not None and not scanner.background:
+		drawscanprogress()
+	else:
+		drawinterfacestatus()
+	if overlay is not None:
+		overlay.draw()
+	compositor.invalidate()
+
+class Modal(object):
+	'''A dialog drawn over the current screen. It is closed with one of its
+	buttons, given as (button, label) pairs, or once its timeout in seconds
+	has expired. A dialog with a timeout can also be dismissed early with A or
+	B. run() blocks on events until the dialog is closed and returns the
+	button that closed it, or None. Alternatively, it can be opened as an
+	overlay (see openoverlay()) so that the main loop, and any background
+	work, carries on while it is shown; onclose is then called with the
+	result once it has been closed.
+	'''
+	def __init__(self, text, buttons=(), timeout=None, onclose=None):
+		self.keys = {'a': K_LCTRL, 'b': K_LALT, 'x': K_LSHIFT, 'y': K_SPACE}
+		self.text = text
+		self.buttons = buttons
+		self.timeout = timeout
+		self.onclose = onclose
+		self.result = None
+		self.closed = False
 
-def modal(text, wait=False, timeout=False, query=False):
-	global colors
-	dialog = pygame.draw.rect(surface, colors['lightbg'], (64,88,192,72))
-	pygame.draw.rect(surface, colors['white'], (62,86,194,74), 2)
+	def draw(self):
+		global colors
+		dialog = pygame.draw.rect(surface, colors['lightbg'], (64,88,192,72))
+		pygame.draw.rect(surface, colors['white'], (62,86,194,74), 2)
+
+		text = textcache.render(font_medium, self.text, True, colors['white'], colors['lightbg'])
+		modal_text = text.get_rect()
+		modal_text.center = dialog.center
+
+		surface.blit(text, modal_text)
+
+		# Buttons are laid out right to left from the bottom right corner
+		x = 205
+		for button, label in reversed(self.buttons):
+			hint(button, label, x, 145, colors['lightbg'])
+			x -= 55
+		compositor.invalidate((62, 86, 196, 76))
+
+	def open(self):
+		self.draw()
+		if self.timeout:
+			pygame.time.set_timer(MODALEVENT, int(self.timeout * 1000))
+		return self
+
+	def close(self, result=None):
+		if self.timeout:
+			pygame.time.set_timer(MODALEVENT, 0)
+		self.result = result
+		self.closed = True
+
+	def handle(self, event):
+		'''Returns True if the event was consumed by the dialog.'''
+		if event.type == MODALEVENT:
+			self.close()
+			return True
+		if event.type != KEYDOWN:
+			return False
+		for button, label in self.buttons:
+			if event.key == self.keys[button]:
+				self.close(button)
+				return True
+		if self.timeout and event.key in (K_LCTRL, K_LALT):
+			self.close()
+		return True
+
+	def run(self):
+		self.open()
+		deferred = []
+		while not self.closed:
+			event = waitevent()
+			if not self.handle(event) and (event.type == QUIT or event.type >= USEREVENT):
+				defer(deferred, event)
+		# Hand anything meant for the main loop back to it
+		for event in deferred:
+			pygame.event.post(event)
+		return self.result
+
+class ConnectDialog(Modal):
+	'''Shows the progress of a ConnectWorker through its phases. Cancelling
+	it cancels the connection.
+	'''
 
-	text = font_medium.render(text, True, colors['white'], colors['lightbg'])
-	modal_text = text.get_rect()
-	modal_text.center = dialog.center
+	def __init__(self, worker):
+		Modal.__init__(self, "Connecting...", [('b', 'Cancel')], onclose=self.cancel)
+		self.worker = worker
 
-	surface.blit(text, modal_text)
-	pygame.display.update()
+	def draw(self):
+		global colors
+		if self.worker.phase is not None:
+			self.text = ConnectWorker.labels[self.worker.phase]
+		Modal.draw(self)
+
+		phases = ConnectWorker.phases
+		current = phases.index(self.worker.phase) if self.worker.phase in phases else -1
+		for i in range(len(phases)):
+			step = Rect(80 + i * 40, 98, 36, 6)
+			if i < current:
+				pygame.draw.rect(surface, colors['white'], step)
+			elif i == current:
+				pygame.draw.rect(surface, colors['activeselbg'], step)
+			else:
+				pygame.draw.rect(surface, colors['white'], step, 1)
+
+	def cancel(self, button):
+		if button == 'b':
+			self.worker.cancel()
+
+def openoverlay(dialog):
+	global overlay
+	overlay = dialog.open()
+
+def closeoverlay(dialog):
+	'''Takes a dialog down without calling its onclose.'''
+	global overlay
+	if overlay is dialog:
+		dialog.close()
+		overlay = None
+
+def handleoverlay(event):
+	'''Passes an event to the overlay, if there is one. Returns True if the
+	overlay consumed it.'''
+	global overlay
+	if overlay is None or not overlay.handle(event):
+		return False
+	if overlay.closed:
+		closed, overlay = overlay, None
+		redraw()
+		if closed.onclose is not None:
+			closed.onclose(closed.result)
+	return True
 
+def modal(text, wait=False, timeout=False, query=False):
 	if wait:
-		abutton = hint("a", "Continue", 205, 145, colors['lightbg'])
-		pygame.display.update()
+		Modal(text, [('a', 'Continue')]).run()
+		redraw()
 	elif timeout:
-		time.sleep(2.5)
+		Modal(text, timeout=2.5).run()
 		redraw()
 	elif query:
-		abutton = hint("a", "Confirm", 150, 145, colors['lightbg'])
-		bbutton = hint("b", "Cancel", 205, 145, colors['lightbg'])
-		pygame.display.update()
-		while True:
-			for event in pygame.event.get():
-				if event.type == KEYDOWN:
-					if event.key == K_LCTRL:
-						return True
-					elif event.key == K_LALT:
-						return
-
-	if not wait:
-		return
-
-	while True:
-		for event in pygame.event.get():
-			if event.type == KEYDOWN and event.key == K_LCTRL:
-				redraw()
-				return
+		if Modal(text, [('a', 'Confirm'), ('b', 'Cancel')]).run() == 'a':
+			return True
+	else:
+		Modal(text).open()
+		compositor.flush()
 
 # Connect to a network
+@traced('writeconfig')
 def writeconfig(): # Write wireless configuration to disk
 	global passphrase
 	global encryption
 	try:
 		encryption
 	except NameError:
-		encryption = uniq[ssid]['Encryption']
+		encryption = uniq.get(ssid)['Encryption']
 
 	if passphrase:
 		if passphrase == "none":
@@ -593,6 +1693,7 @@ def writeconfig(): # Write wireless configuration to disk
 	f.write('WLAN_ENCRYPTION="'+encryption+'"\n')
 	f.write('WLAN_DHCP_RETRIES=20\n')
 	f.close()
+	savednetworks.update(quote_plus(ssid) + ".conf")
 
 # HostAP
 def startap():
@@ -601,7 +1702,9 @@ def startap():
 		disconnect(wlan)
 
 	modal("Creating AP...")
-	if SU.Popen(['ap', '--start'], close_fds=True).wait() == 0:
+	created = call(['ap', '--start']) == 0
+	invalidatestatus(wlan)
+	if created:
 		modal('AP created!', timeout=True)
 	else:
 		modal('Failed to create AP...', wait=True)
@@ -610,6 +1713,40 @@ def startap():
 
 # Input methods
 
+# Events for the main loop that arrived while an input loop below had the
+# screen. They can't be dropped: a worker only wakes the main loop up once
+# until it is drained, so a lost SCANEVENT would leave its scan stuck.
+deferred = []
+
+def defer(pending, event):
+	'''Adds event to the pending list unless one of its type is there already.
+	None of these events carry anything but their type, and the timers keep
+	firing while an input loop has the screen: SDL's queue only holds 127
+	events, so posting every one of them back would overflow it.'''
+	if all(other.type != event.type for other in pending):
+		pending.append(event)
+
+def waitkey():
+	'''waitevent() for the input loops below: returns the next key press, and
+	keeps whatever is meant for the main loop in deferred.'''
+	while True:
+		event = waitevent()
+		if event.type == KEYDOWN:
+			return event
+		if event.type == QUIT or event.type >= USEREVENT:
+			defer(deferred, event)
+
+def deferring(function):  # Decorator for input loops that use waitkey()
+	@wraps(function)
+	def wrapper(*args, **kwargs):
+		try:
+			return function(*args, **kwargs)
+		finally:
+			# Hand anything meant for the main loop back to it
+			while deferred:
+				pygame.event.post(deferred.pop(0))
+	return wrapper
+
 keyLayouts = {
 	'qwertyNormal': (
 			('`', '1', '2', '3', '4', '5', '6', '7', '8', '9', '0', '-', '='),
@@ -667,7 +1804,7 @@ class key:
             key_width = 36
         keybox = pygame.draw.rect(
             surface, colors['lightbg'], (left, top, key_width, key_height))
-        text = font_medium.render(
+        text = textcache.render(font_medium,
             self.key, True, colors['white'], colors['lightbg'])
         label = text.get_rect()
         label.center = keybox.center
@@ -725,7 +1862,7 @@ class radio:
             key_width = 64
         radiobutton = aaFilledCircle(colors['white'], (left, top), 8)
         aaFilledCircle(colors['darkbg'], (left, top), 6)
-        text = font_medium.render(
+        text = textcache.render(font_medium,
             self.key, True, (255, 255, 255), colors['darkbg'])
         label = text.get_rect()
         label.left = radiobutton.right + 8
@@ -758,7 +1895,7 @@ def drawEncryptionType():
 	for i, label in enumerate(encryptionLabels):
 		z.init(label, 0, i)
 
-	pygame.display.update()
+	compositor.invalidate((0, 40, screen_width, 200))
 
 def displayencryptionhint():
 	global colors
@@ -784,10 +1921,10 @@ def displayencryptionhint():
 				if enc == encryption:
 					# Draw a selection rectangle for the active encryption method
 					pygame.draw.rect(surface, colors['activeselbg'], labelblock)
-				labeltext = font_small.render(enc.center(10, ' '), True, colors["white"])
+				labeltext = textcache.render(font_small, enc.center(10, ' '), True, colors["white"])
 				surface.blit(labeltext, labelblock)
 				pos += 1
-			pygame.display.update()
+			compositor.invalidate((0, 100, screen_width, 34))
 	except NameError:
 		pass
 
@@ -812,8 +1949,7 @@ def chooseencryption(direction):
 
 	drawEncryptionType()
 	pos = (32 + selected_key[0] * 64, 136)
-	aafilledcircle(surface, colors['activeselbg'], pos, 6)
-	pygame.display.update()
+	compositor.invalidate(aafilledcircle(surface, colors['activeselbg'], pos, 6))
 
 	return encryption
 
@@ -843,61 +1979,114 @@ def nextEncryption():
 				encryption = encryptiontypes[0]
 				return
 
+@deferring
 def getEncryptionType():
 	chooseencryption("init")
 	while True:
-		for event in pygame.event.get():
-			if event.type == KEYDOWN:
-				if event.key == K_LEFT:		# Move cursor left
-					chooseencryption("left")
-				if event.key == K_RIGHT:	# Move cursor right
-					chooseencryption("right")
-				if event.key == K_LCTRL:	# A button
-					return chooseencryption("select")
-				if event.key == K_ESCAPE:	# Select key
-					return 'cancel'
+		event = waitkey()
+		if event.type == KEYDOWN:
+			if event.key == K_LEFT:		# Move cursor left
+				chooseencryption("left")
+			if event.key == K_RIGHT:	# Move cursor right
+				chooseencryption("right")
+			if event.key == K_LCTRL:	# A button
+				return chooseencryption("select")
+			if event.key == K_ESCAPE:	# Select key
+				return 'cancel'
 
-def drawkeyboard(board):
-	global colors
-	
-	# Draw keyboard background
-	pygame.draw.rect(surface, colors['darkbg'],
-	                 (0, 124, screen_width, screen_height - 124))
+class Keyboard(object):
+	'''An on-screen keyboard layout. The first time a layout is shown it is
+	drawn key by key and a copy of the keyboard area is kept, so that showing
+	it again is a single blit and moving the cursor only has to restore the
+	key it leaves.
+	'''
+	shown = None
+
+	def __init__(self, board):
+		self.board = board
+		self.area = Rect(0, 124, screen_width, screen_height - 124)
+		self.image = None
+		self.cursor = None
+
+		# Key geometry, matching key.drawkey()
+		self.keys = []
+		for row, rowData in enumerate(keyLayouts[board]):
+			top = screen_height - 104 + row * 20
+			self.keys.append([
+				Rect((screen_width / 2) - 128 + column * 20, top,
+					36 if len(label) > 1 else 16, 16)
+				for column, label in enumerate(rowData)])
 
-	# Draw bottom background
-	pygame.draw.rect(surface, colors['lightbg'],
-	                 (0, screen_height - 16, screen_width, 16))
-	pygame.draw.line(surface, colors['white'],
-                  (0, screen_height - 17), (screen_width, screen_height - 17))
+	def draw(self):
+		if self.image is None:
+			self.render()
+			self.image = surface.subsurface(self.area).copy()
+		else:
+			surface.blit(self.image, self.area)
+		compositor.invalidate(self.area)
+		self.cursor = None
+		Keyboard.shown = self
 
-	hint_y = screen_height - 13
+	def render(self):
+		global colors
 
-	#    Button		Label		x-pos		y-pos	    Background color
-	hint("select", 	"Cancel", 	4, 			hint_y, 	colors['lightbg'])
-	hint("start", 	"Finish", 	75, 		hint_y, 	colors['lightbg'])
-	hint("x", 		"Delete",	155, 		hint_y, 	colors['lightbg'])
+		# Draw keyboard background
+		pygame.draw.rect(surface, colors['darkbg'], self.area)
 
-	if not board == "wep":
-		hint("y", "Shift", 200, hint_y, colors['lightbg'])
-		hint("b", "Space", 240, hint_y, colors['lightbg'])
+		# Draw bottom background
+		pygame.draw.rect(surface, colors['lightbg'],
+		                 (0, screen_height - 16, screen_width, 16))
+		pygame.draw.line(surface, colors['white'],
+	                  (0, screen_height - 17), (screen_width, screen_height - 17))
 
-	else:
-		hint("y", "Full KB", 200, hint_y, colors['lightbg'])
+		hint_y = screen_height - 13
 
-	hint("a", "Enter", 285, hint_y, colors['lightbg'])
+		#    Button		Label		x-pos		y-pos	    Background color
+		hint("select", 	"Cancel", 	4, 			hint_y, 	colors['lightbg'])
+		hint("start", 	"Finish", 	75, 		hint_y, 	colors['lightbg'])
+		hint("x", 		"Delete",	155, 		hint_y, 	colors['lightbg'])
 
-	# Draw the keys
-	z = key()
-	for row, rowData in enumerate(keyLayouts[board]):
-		for column, label in enumerate(rowData):
-			z.init(label, row, column)
+		if not self.board == "wep":
+			hint("y", "Shift", 200, hint_y, colors['lightbg'])
+			hint("b", "Space", 240, hint_y, colors['lightbg'])
+
+		else:
+			hint("y", "Full KB", 200, hint_y, colors['lightbg'])
+
+		hint("a", "Enter", 285, hint_y, colors['lightbg'])
+
+		# Draw the keys
+		z = key()
+		for row, rowData in enumerate(keyLayouts[self.board]):
+			for column, label in enumerate(rowData):
+				z.init(label, row, column)
+
+	def highlight(self, row, column):
+		if self.cursor is not None:
+			surface.blit(self.image, self.cursor, self.cursor.move(-self.area.x, -self.area.y))
+			compositor.invalidate(self.cursor)
+
+		x, y = self.keys[row][column].topleft
+		pointlist = [
+				(x, y),
+				(x + 16, y),
+				(x + 16, y + 16),
+				(x, y + 16),
+				(x, y)
+				]
+		self.cursor = pygame.draw.lines(surface, (255,255,255), True, pointlist, 1)
+		compositor.invalidate(self.cursor)
+
+keyboards = LazyDict(Keyboard)
 
-	pygame.display.update()
+def drawkeyboard(board):
+	keyboards[board].draw()
 
 def getinput(board, kind, ssid=""):
 	selectkey(board, kind)
 	return softkeyinput(board, kind, ssid)
 
+@deferring
 def softkeyinput(keyboard, kind, ssid):
 	global passphrase
 	global encryption
@@ -907,7 +2096,7 @@ def softkeyinput(keyboard, kind, ssid):
 		displayencryptionhint()
 
 	while True:
-		event = pygame.event.wait()
+		event = waitkey()
 
 		if event.type == KEYDOWN:
 			if event.key == K_RETURN:		# finish input
@@ -972,9 +2161,9 @@ def displayinputlabel(kind, size=24): # Display passphrase on screen
 
 	if kind == "ssid":
 		# Draw SSID and encryption type labels
-		pygame.draw.rect(surface, colors['darkbg'], (0,100,screen_width,34))
+		compositor.invalidate(pygame.draw.rect(surface, colors['darkbg'], (0,100,screen_width,34)))
 		labelblock = pygame.draw.rect(surface, colors['white'], (0,35,screen_width,20))
-		labeltext = font_large.render("Enter new SSID", True, colors['lightbg'], colors['white'])
+		labeltext = textcache.render(font_large, "Enter new SSID", True, colors['lightbg'], colors['white'])
 		label = labeltext.get_rect()
 		label.center = labelblock.center
 		surface.blit(labeltext, label)
@@ -983,7 +2172,7 @@ def displayinputlabel(kind, size=24): # Display passphrase on screen
 		displayencryptionhint()
 		# Draw SSID and encryption type labels
 		labelblock = pygame.draw.rect(surface, colors['white'], (0,35,screen_width,20))
-		labeltext = font_large.render("Enter "+encryption+" key", True, colors['lightbg'], colors['white'])
+		labeltext = textcache.render(font_large, "Enter "+encryption+" key", True, colors['lightbg'], colors['white'])
 		label = labeltext.get_rect()
 		label.center = labelblock.center
 		surface.blit(labeltext, label)
@@ -994,40 +2183,17 @@ def displayinputlabel(kind, size=24): # Display passphrase on screen
 	text = "[ "
 	text += passphrase
 	text += " ]"
-	pw = font_mono_small.render(text, True, (0, 0, 0), colors['white'])
+	pw = textcache.render(font_mono_small, text, True, (0, 0, 0), colors['white'])
 	pwtext = pw.get_rect()
 	pwtext.center = bg.center
 	surface.blit(pw, pwtext)
-	pygame.display.update()
+	compositor.invalidate((0, 35, screen_width, 65))
 
 def selectkey(keyboard, kind, direction=""):
 	def highlightkey(keyboard, pos='[0,0]'):
-		drawkeyboard(keyboard)
-		pygame.display.update()
-
-		left_margin = (screen_width / 2) - 128
-		top_margin = screen_height - 104
-
-		if pos[0] > left_margin:
-			x = left_margin + (16 * (pos[0]))
-		else:
-			x = left_margin + (16 * pos[0]) + (pos[0] * 4)
-
-
-		if pos[1] > top_margin:
-			y = top_margin + (16 * (pos[1]))
-		else:
-			y = top_margin + (16 * pos[1]) + (pos[1] * 4)
-
-		pointlist = [
-				(x, y),
-				(x + 16, y),
-				(x + 16, y + 16),
-				(x, y + 16),
-				(x, y)
-				]
-		lines = pygame.draw.lines(surface, (255,255,255), True, pointlist, 1)
-		pygame.display.update()
+		if Keyboard.shown is not keyboards[keyboard]:
+			drawkeyboard(keyboard)
+		keyboards[keyboard].highlight(pos[1], pos[0])
 
 	global selected_key
 	global passphrase
@@ -1084,6 +2250,7 @@ class Menu:
 	font = font_medium
 	dest_surface = surface
 	canvas_color = colors["darkbg"]
+	rowcache_size = 32
 
 	elements = []
 
@@ -1096,6 +2263,8 @@ class Menu:
 		self.selection_color = colors["activeselbg"]
 		self.text_color = colors["activetext"]
 		self.font = font_medium
+		self.rows = OrderedDict()
+		self.canvas = None
 
 	def move_menu(self, top, left):
 		self.origin = (top, left)
@@ -1117,9 +2286,32 @@ class Menu:
 		self.set_elements(elements)
 		self.dest_surface = dest_surface
 
+	def get_row(self, element, selected, width, height):
+		'''Returns an element rendered as a row of the menu. Rows are kept in
+		a small LRU cache keyed by everything that shows in them, so moving
+		the selection only renders the rows that changed.
+		'''
+		key = (element, selected, width, height, self.text_color, self.selection_color)
+		try:
+			row = self.rows.pop(key)
+		except KeyError:
+			row = pygame.Surface((width, height))
+			row.fill(self.selection_color if selected else self.canvas_color)
+			self.render_element(row, element, 0, 0)
+			if len(self.rows) >= self.rowcache_size:
+				self.rows.popitem(last=False)
+		self.rows[key] = row
+		return row
+
+	def get_canvas(self, width, height): # The surface rows are composed on
+		if self.canvas is None or self.canvas.get_size() != (width, height):
+			self.canvas = pygame.Surface((width, height))
+		return self.canvas
+
+	@traced('Menu.draw')
 	def draw(self,move=0):
 		# Clear any old text (like from apinfo()), but don't overwrite button hint area above statusbar
-		pygame.draw.rect(surface, colors['darkbg'], (0,35,320,173))
+		compositor.invalidate(pygame.draw.rect(surface, colors['darkbg'], (0,35,320,173)))
 
 		if len(self.elements) == 0:
 			return
@@ -1143,70 +2335,76 @@ class Menu:
 		heights = [self.get_item_height(visible_element) for visible_element in visible_elements]
 		total_height = sum(heights)
 
-		# Background
-		menu_surface = pygame.Surface((max_width, total_height))
-		menu_surface.fill(self.canvas_color)
-
-		# Selection
-		left = 0
-		top = sum(heights[0:selected_within_visible])
-		width = max_width
-		height = heights[selected_within_visible]
-		selection_rect = (left, top, width, height)
-		pygame.draw.rect(menu_surface,self.selection_color,selection_rect)
-
 		# Clear any error elements
-		error_rect = (left+width+8, 35, 192, 172)
+		error_rect = (max_width+8, 35, 192, 172)
 		pygame.draw.rect(surface,colors['darkbg'],error_rect)
 
 		# Elements
+		menu_surface = self.get_canvas(max_width, total_height)
 		top = 0
 		for i in range(len(visible_elements)):
-			self.render_element(menu_surface, visible_elements[i], 0, top)
+			row = self.get_row(visible_elements[i], i == selected_within_visible, max_width, heights[i])
+			menu_surface.blit(row, (0, top))
 			top += heights[i]
 		self.dest_surface.blit(menu_surface,self.origin)
 		return self.selected_item
 
 	def get_item_height(self, element):
-		render = self.font.render(element, 1, self.text_color)
+		height = self.font.size(element)[1]
 		spacing = 5
-		return render.get_rect().height + spacing * 2
+		return height + spacing * 2
 
 	def get_item_width(self, element):
-		render = self.font.render(element, 1, self.text_color)
+		width = self.font.size(element)[0]
 		spacing = 5
-		return render.get_rect().width + spacing * 2
+		return width + spacing * 2
 
 	def render_element(self, menu_surface, element, left, top):
-		render = self.font.render(element, 1, self.text_color)
+		render = textcache.render(self.font, element, 1, self.text_color)
 		spacing = 5
 		menu_surface.blit(render, (left + spacing, top + spacing, render.get_rect().width, render.get_rect().height))
 
 class NetworksMenu(Menu):
+	networks = None
+	drawn_height = 0
+
 	def set_elements(self, elements):
 		self.elements = elements
 
+	def set_networks(self, networks):
+		# Keep the same network selected, wherever it has moved to
+		selected = self.get_selected_network()
+		if selected is not None and selected['ESSID'] in networks:
+			self.selected_item = networks.index(selected['ESSID'])
+		elif self.selected_item >= len(networks):
+			self.selected_item = max(len(networks) - 1, 0)
+		self.networks = networks
+		now = time.time()
+		self.set_elements([(detail['ESSID'], detail['Quality'], detail['Encryption'].upper(),
+			agelabel(now - detail['Seen']) if detail.get('Missed') else '')
+			for detail in networks])
+
+	def get_selected_network(self):
+		if not self.networks or self.selected_item >= len(self.networks):
+			return None
+		return self.networks[self.selected_item]
+
 	def get_item_width(self, element):
 		the_ssid = element[0]
-		render = self.font.render(the_ssid, 1, self.text_color)
+		width = self.font.size(the_ssid)[0]
 		spacing = 15
-		return render.get_rect().width + spacing * 2
+		return width + spacing * 2
 
 	def get_item_height(self, element):
-		render = self.font.render(element[0], 1, self.text_color)
+		height = self.font.size(element[0])[1]
 		spacing = 6
-		return (render.get_rect().height + spacing * 2) + 5
+		return (height + spacing * 2) + 5
 
 	def render_element(self, menu_surface, element, left, top):
 		the_ssid = element[0]
 
-		def qualityPercent(x):
-			percent = (float(x.split("/")[0]) / float(x.split("/")[1])) * 100
-			if percent > 100:
-				percent = 100
-			return int(percent)
 		# Wifi signal icons
-		percent = qualityPercent(element[1])
+		percent = int(qualityfraction(element[1]) * 100)
 
 		if percent >= 6 and percent <= 24:
 			signal_icon = 'wifi-0.png'
@@ -1236,11 +2434,15 @@ class NetworksMenu(Menu):
 			enc_type = "(Unknown)"
 
 
-		qual_img = pygame.image.load((os.path.join(datadir, signal_icon))).convert_alpha()
-		enc_img = pygame.image.load((os.path.join(datadir, enc_icon))).convert_alpha()
+		qual_img = icons[signal_icon]
+		enc_img = icons[enc_icon]
 
-		ssid = font_mono_small.render(the_ssid, 1, self.text_color)
-		enc = font_small.render(enc_type, 1, colors["lightgrey"])
+		# Networks missed by the latest scan are shown with their age
+		if len(element) > 3 and element[3]:
+			enc_type += "  (" + element[3] + ")"
+
+		ssid = textcache.render(font_mono_small, the_ssid, 1, self.text_color)
+		enc = textcache.render(font_small, enc_type, 1, colors["lightgrey"])
 		# strength = font_small.render(str(str(percent) + "%").rjust(4), 1, colors["lightgrey"])
 		# qual = font_small.render(element[1], 1, colors["lightgrey"])
 		spacing = 2
@@ -1252,8 +2454,8 @@ class NetworksMenu(Menu):
 		qual_x = left + 200 - qual_img.get_rect().width - 3
 		qual_y = top + 7 + 6 
 		menu_surface.blit(qual_img, (qual_x, qual_y))
-		pygame.display.update()
 
+	@traced('NetworksMenu.draw')
 	def draw(self,move=0):
 		if len(self.elements) == 0:
 			return
@@ -1282,24 +2484,20 @@ class NetworksMenu(Menu):
 		heights = [self.get_item_height(visible_element) for visible_element in visible_elements]
 		total_height = sum(heights)
 
-		# Background
-		menu_surface = pygame.Surface((max_width, total_height))
-		menu_surface.fill(self.canvas_color)
-
-		# Selection
-		left = 0
-		top = sum(heights[0:selected_within_visible])
-		width = max_width
-		height = heights[selected_within_visible]
-		selection_rect = (left, top, width, height)
-		pygame.draw.rect(menu_surface,self.selection_color,selection_rect)
-
-		# Elements
+		# Elements; only rows that were not on screen before get rendered
+		menu_surface = self.get_canvas(max_width, total_height)
 		top = 0
 		for i in range(len(visible_elements)):
-			self.render_element(menu_surface, visible_elements[i], 0, top)
+			row = self.get_row(visible_elements[i], i == selected_within_visible, max_width, heights[i])
+			menu_surface.blit(row, (0, top))
 			top += heights[i]
-		self.dest_surface.blit(menu_surface,self.origin)
+		compositor.invalidate(self.dest_surface.blit(menu_surface,self.origin))
+
+		# Clear what is left of a longer list
+		if total_height < self.drawn_height:
+			compositor.invalidate(pygame.draw.rect(self.dest_surface, self.canvas_color,
+				(self.origin[0], self.origin[1] + total_height, max_width, self.drawn_height - total_height)))
+		self.drawn_height = total_height
 		return self.selected_item
 
 def to_menu(new_menu):
@@ -1314,6 +2512,9 @@ def to_menu(new_menu):
 	return new_menu
 
 wirelessmenu = None
+scanner = None
+connector = None
+overlay = None
 menu = Menu()
 menu.move_menu(3, 41)
 
@@ -1349,41 +2550,40 @@ def apinfo():
 		file.close()
 		if mac == ap:
 			ssidlabel = "SSID"
-			renderedssidlabel = font_huge.render(ssidlabel, True, colors["lightbg"], colors["darkbg"])
+			renderedssidlabel = textcache.render(font_huge, ssidlabel, True, colors["lightbg"], colors["darkbg"])
 			ssidlabelelement = renderedssidlabel.get_rect()
 			ssidlabelelement.right = 318
 			ssidlabelelement.top = 34
 			surface.blit(renderedssidlabel, ssidlabelelement)
 
 			ssid = getcurrentssid(wlan)
-			renderedssid = font_mono_small.render(ssid, True, colors["white"], colors["darkbg"])
+			renderedssid = textcache.render(font_mono_small, ssid, True, colors["white"], colors["darkbg"])
 			ssidelement = renderedssid.get_rect()
 			ssidelement.right = 315
 			ssidelement.top = 96
 			surface.blit(renderedssid, ssidelement)
 
 			enclabel = "Key"
-			renderedenclabel = font_huge.render(enclabel, True, colors["lightbg"], colors["darkbg"])
+			renderedenclabel = textcache.render(font_huge, enclabel, True, colors["lightbg"], colors["darkbg"])
 			enclabelelement = renderedenclabel.get_rect()
 			enclabelelement.right = 314 # Drawn a bit leftwards versus "SSID" text, so both right-align pixel-perfectly
 			enclabelelement.top = 114
 			surface.blit(renderedenclabel, enclabelelement)
 
-			renderedencp = font_mono_small.render(mac, True, colors["white"], colors["darkbg"])
+			renderedencp = textcache.render(font_mono_small, mac, True, colors["white"], colors["darkbg"])
 			encpelement = renderedencp.get_rect()
 			encpelement.right = 315
 			encpelement.top = 180
 			surface.blit(renderedencp, encpelement)
 
-			pygame.display.update()
+			compositor.invalidate((0, 35, screen_width, 173))
 	except:
 		text = ":("
-		renderedtext = font_huge.render(text, True, colors["lightbg"], colors["darkbg"])
+		renderedtext = textcache.render(font_huge, text, True, colors["lightbg"], colors["darkbg"])
 		textelement = renderedtext.get_rect()
 		textelement.left = 192
 		textelement.top = 96
-		surface.blit(renderedtext, textelement)
-		pygame.display.update()
+		compositor.invalidate(surface.blit(renderedtext, textelement))
 
 def create_wireless_menu():
 	global wirelessmenu
@@ -1394,64 +2594,519 @@ def destroy_wireless_menu():
 	global wirelessmenu
 	wirelessmenu = None
 
-def create_saved_networks_menu():
-	global uniq
+def parseconf(path): # Read a saved network configuration
+	detail = {
+		'ESSID': unquote_plus(os.path.basename(path)[:-5]),
+		'Encryption': '',
+		'Key': '',
+		}
+	with open(path) as f:
+		for line in f:
+			key, value = line.split('=', 1)
+			key = key.strip()
+			value = value.strip()
+			if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+				value = value[1:-1]
+
+			if key == 'WLAN_ESSID':
+				detail['ESSID'] = value
+			elif key == 'WLAN_ENCRYPTION':
+				detail['Encryption'] = value
+			elif key == 'WLAN_PASSPHRASE':
+				# TODO: fix for 128-bit wep
+				detail['Key'] = value
+	return detail
+
+
+class SavedNetworks(object):
+	'''An index of the saved network configurations in netconfdir, kept in a
+	file under confdir so that they don't all have to be opened and parsed
+	every time the list is shown. On refresh(), the directory listing is only
+	re-read if the directory's mtime has changed, and only configurations
+	whose mtime has changed are parsed again. The index is rebuilt from
+	scratch only if it is missing or corrupt.
+
+	The index is a header line followed by one line per configuration, with
+	every field but the mtimes quoted with quote_plus():
+	    gcwconnect-index <version> <directory mtime>
+	    <file name> <mtime> <ESSID> <encryption> <key>
+	'''
+	version = 1
+	fields = ('ESSID', 'Encryption', 'Key')
 
-	uniqssids = {}
-	menu = 1
-	for confName in sorted(listdir(netconfdir)):
-		if not confName.endswith('.conf'):
-			continue
-		ssid = unquote_plus(confName[:-5])
-
-		detail = {
-			'ESSID': ssid,
-			'Encryption': '',
-			'Key': '',
-			'Quality': '0/1',
-			'menu': menu,
-			}
+	def __init__(self, directory, path):
+		self.directory = directory
+		self.path = path
+		self.entries = None
+		self.dirmtime = None
+
+	def load(self):
 		try:
-			with open(netconfdir + confName) as f:
-				for line in f:
-					key, value = line.split('=', 1)
-					key = key.strip()
-					value = value.strip()
-					if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
-						value = value[1:-1]
-
-					if key == 'WLAN_ESSID':
-						detail['ESSID'] = value
-					elif key == 'WLAN_ENCRYPTION':
-						detail['Encryption'] = value
-					elif key == 'WLAN_PASSPHRASE':
-						# TODO: fix for 128-bit wep
-						detail['Key'] = value
-		except IOError as ex:
-			print('Error reading conf:', ex)
+			(dirmtime,), records = loadrecords(self.path, 'gcwconnect-index', self.version)
+			dirmtime = float(dirmtime)
+			entries = {}
+			for name, mtime, essid, encryption, key in records:
+				entries[unquote_plus(name)] = {
+					'mtime': float(mtime),
+					'ESSID': unquote_plus(essid),
+					'Encryption': unquote_plus(encryption),
+					'Key': unquote_plus(key),
+					}
+		except (IOError, ValueError):
+			self.entries = {}
+			self.dirmtime = None
+			return False
+		self.entries = entries
+		self.dirmtime = dirmtime
+		return True
+
+	def save(self):
+		records = [[quote_plus(name), repr(entry['mtime'])] +
+				[quote_plus(entry[field]) for field in self.fields]
+			for name, entry in sorted(self.entries.iteritems())]
+		saverecords(self.path, 'gcwconnect-index', self.version,
+			[repr(self.dirmtime)], records, 'index')
+
+	def index(self, name):
+		try:
+			mtime = os.stat(self.directory + name).st_mtime
+			entry = parseconf(self.directory + name)
+		except (IOError, OSError) as ex:
+			sys.stderr.write("Error reading conf: %s\n" % ex)
 		except ValueError as ex:
-			print('Error parsing conf line:', line.strip())
+			sys.stderr.write("Error parsing conf: %s\n" % name)
+		else:
+			entry['mtime'] = mtime
+			self.entries[name] = entry
+			return True
+		self.entries.pop(name, None)
+		return False
+
+	def refresh(self):
+		'''Brings the index up to date, and returns {file name: detail} for
+		every saved network.'''
+		if self.entries is None:
+			self.load()
+		changed = False
+
+		dirmtime = os.stat(self.directory).st_mtime
+		if dirmtime != self.dirmtime:
+			names = [name for name in listdir(self.directory) if name.endswith('.conf')]
+			for name in set(self.entries) - set(names):
+				del self.entries[name]
+			self.dirmtime = dirmtime
+			changed = True
 		else:
-			uniqssids[ssid] = detail
-			menu += 1
-	uniq = uniqssids
+			names = list(self.entries)
+
+		for name in names:
+			try:
+				mtime = os.stat(self.directory + name).st_mtime
+			except OSError:
+				mtime = None
+			entry = self.entries.get(name)
+			if entry is None or entry['mtime'] != mtime:
+				self.index(name)
+				changed = True
+
+		if changed:
+			self.save()
+		return self.entries
+
+	def update(self, name):
+		'''Re-reads a configuration that has just been written.'''
+		if self.dirmtime is not None:
+			self.index(name)
+			self.save()
+
+	def remove(self, name):
+		os.remove(self.directory + name)
+		if self.dirmtime is not None and self.entries.pop(name, None) is not None:
+			self.save()
+
+savednetworks = SavedNetworks(netconfdir, confdir + "networks.index")
+
+class ConnectHistory(object):
+	'''How often connecting to each network has worked and failed, kept in a
+	file under confdir so that auto-join can prefer the networks that tend
+	to work. The file is a header line followed by one line per network:
+	    gcwconnect-history <version>
+	    <ESSID, quoted with quote_plus()> <successes> <failures>
+	'''
+	version = 1
+
+	def __init__(self, path):
+		self.path = path
+		self.counts = None
+
+	def load(self):
+		self.counts = {}
+		try:
+			header, records = loadrecords(self.path, 'gcwconnect-history', self.version)
+			for essid, successes, failures in records:
+				self.counts[unquote_plus(essid)] = [int(successes), int(failures)]
+		except (IOError, ValueError):
+			self.counts = {}
+
+	def save(self):
+		records = [[quote_plus(essid), str(successes), str(failures)]
+			for essid, (successes, failures) in sorted(self.counts.iteritems())]
+		saverecords(self.path, 'gcwconnect-history', self.version, [], records, 'history')
+
+	def record(self, ssid, success):
+		if self.counts is None:
+			self.load()
+		self.counts.setdefault(ssid, [0, 0])[0 if success else 1] += 1
+		self.save()
+
+	def successrate(self, ssid):
+		'''The share of attempts that worked. Networks with no history count as
+		having worked half of the time.'''
+		if self.counts is None:
+			self.load()
+		successes, failures = self.counts.get(ssid, (0, 0))
+		return (successes + 1.0) / (successes + failures + 2.0)
+
+connecthistory = ConnectHistory(confdir + "history")
+
+def autojoincandidates():
+	'''The saved networks seen by the latest scan, best first. They are
+	ranked by signal, weighted by how often connecting to them has worked.'''
+	saved = set(entry['ESSID'] for entry in savednetworks.refresh().itervalues())
+	candidates = []
+	for detail in listuniqssids():
+		if detail['ESSID'] in saved and not detail.get('Missed'):
+			score = qualityfraction(detail['Quality']) * connecthistory.successrate(detail['ESSID'])
+			candidates.append((score, detail['ESSID']))
+	candidates.sort(reverse=True)
+	return [essid for _, essid in candidates]
+
+class AutoJoin(object):
+	'''Works through the auto-join candidates, one connection attempt at a
+	time, and logs on stderr how long it took to get connected.'''
+
+	def __init__(self):
+		self.started = time.time()
+		self.candidates = None
+		self.attempts = 0
+		self.wasnotenabled = False
+
+	def next(self):  # The next candidate to try, or None
+		if not self.candidates:
+			return None
+		self.attempts += 1
+		return self.candidates.pop(0)
+
+	def connected(self, ssid):
+		sys.stderr.write("autojoin: connected to %s in %.1f s (%d attempt%s)\n" % (
+			ssid, time.time() - self.started, self.attempts, "" if self.attempts == 1 else "s"))
+
+	def failed(self):
+		if self.attempts:
+			sys.stderr.write("autojoin: no saved network could be joined after %.1f s (%d attempts)\n" % (
+				time.time() - self.started, self.attempts))
+		else:
+			sys.stderr.write("autojoin: no saved network in range\n")
+
+joiner = None
+
+def startautojoin():  # Scan, then connect to the best saved network; see joinnext()
+	global joiner
+	if ifacestatus(wlan).ip is not None or not savednetworks.refresh():
+		return
+	joiner = AutoJoin()
+	try:
+		joiner.wasnotenabled = startscan(wlan)
+	except:
+		joiner = None
+
+def joinnext():  # Connect to the next auto-join candidate, if there is one
+	global joiner
+	global ssid
+	candidate = joiner.next()
+	if candidate is None:
+		if joiner.attempts:
+			openoverlay(Modal('Connection failed!', [('a', 'Continue')]))
+		joiner.failed()
+		# Only once every candidate has been tried, as in autojoinheadless()
+		if joiner.wasnotenabled:
+			disableiface()
+		joiner = None
+		return
+	ssid = candidate
+	connect(wlan)
+
+def scannow(iface):
+	'''Scans in the calling thread, without a user interface, and saves the
+	results to the scan cache. Returns True if the interface had to be
+	enabled for it.'''
+	wasnotenabled = enableiface(iface, quiet=True)
+	for mac, network in ScanWorker(iface).scan():
+		network['Missed'] = 0
+		networks.setdefault(mac, dict()).update(network)
+	scancache.save(networks)
+	return wasnotenabled
+
+def autojoinheadless():
+	'''Auto-join without a user interface. Everything runs in the calling
+	thread. Returns True once connected.'''
+	joiner = AutoJoin()
+	wasnotenabled = scannow(wlan)
+	joiner.candidates = autojoincandidates()
+	candidate = joiner.next()
+	while candidate is not None:
+		worker = ConnectWorker(wlan, candidate)
+		success = worker.connect()
+		invalidatestatus(wlan)
+		connecthistory.record(candidate, success)
+		if success:
+			joiner.connected(candidate)
+			return True
+		candidate = joiner.next()
+
+	joiner.failed()
+	if wasnotenabled:
+		disableiface()
+	return False
+
+# Command line interface, for scripts:
+#     gcwconnect.py scan|list|connect <ssid>|forget <ssid>|status
+# Each command prints one JSON object per line on stdout. Failures are printed
+# as {"error": ...} and make the command exit with 1.
+
+jsonout = sys.stdout
+
+def emit(record):
+	for key, value in record.items():
+		if isinstance(value, str):
+			# ESSIDs are bytes, and not necessarily UTF-8
+			record[key] = value.decode('utf-8', 'replace')
+	jsonout.write(json.dumps(record, sort_keys=True) + "\n")
+	jsonout.flush()
+
+def savedconf(ssid):  # The file name of the saved configuration for an SSID
+	return quote_plus(ssid) + ".conf"
+
+def commandscan():
+	networks.update(scancache.load())
+	wasnotenabled = scannow(wlan)
+	if wasnotenabled:
+		disableiface()
+	saved = set(entry['ESSID'] for entry in savednetworks.refresh().itervalues())
+	for detail in listuniqssids():
+		if detail.get('Missed'):
+			continue
+		emit({
+			'ssid': detail['ESSID'],
+			'bssid': detail['BSSID'],
+			'bssids': [mac for mac, network in detail['BSSIDs'] if not network.get('Missed')],
+			'quality': detail['Quality'],
+			'signal': round(qualityfraction(detail['Quality']), 2),
+			'encryption': detail['Encryption'],
+			'channel': detail.get('Channel'),
+			'saved': detail['ESSID'] in saved,
+			})
+	return 0
+
+def commandlist():
+	seen = {}
+	for network in scancache.load().itervalues():
+		seen[network['ESSID']] = max(int(network['Seen']), seen.get(network['ESSID'], 0))
+	entries = savednetworks.refresh()
+	for name in sorted(entries):
+		emit({
+			'ssid': entries[name]['ESSID'],
+			'encryption': entries[name]['Encryption'],
+			'seen': seen.get(entries[name]['ESSID']),
+			'successrate': round(connecthistory.successrate(entries[name]['ESSID']), 2),
+			})
+	return 0
+
+def commandconnect(ssid):
+	if not os.path.exists(netconfdir + savedconf(ssid)):
+		emit({'ssid': ssid, 'error': 'not saved'})
+		return 1
+	started = time.time()
+	enableiface(wlan, quiet=True)
+	worker = ConnectWorker(wlan, ssid)
+	success = worker.connect()
+	invalidatestatus(wlan)
+	connecthistory.record(ssid, success)
+	if not success:
+		emit({'ssid': ssid, 'error': 'failed in phase %s' % worker.phase})
+		return 1
+	emit({'ssid': ssid, 'connected': True, 'ip': ifacestatus(wlan).ip,
+		'seconds': round(time.time() - started, 1)})
+	return 0
+
+def commandforget(ssid):
+	try:
+		savednetworks.remove(savedconf(ssid))
+	except OSError:
+		emit({'ssid': ssid, 'error': 'not saved'})
+		return 1
+	emit({'ssid': ssid, 'forgotten': True})
+	return 0
+
+def commandstatus():
+	status = ifacestatus(wlan)
+	emit({
+		'iface': wlan,
+		'up': status.up,
+		'link': status.link,
+		'ip': status.ip,
+		'ssid': status.ssid,
+		'mac': status.mac,
+		})
+	return 0
+
+def runcommand(args):
+	'''Runs a command line command, and returns the exit status.'''
+	commands = {  # name: (function, number of arguments)
+		'scan': (commandscan, 0),
+		'list': (commandlist, 0),
+		'connect': (commandconnect, 1),
+		'forget': (commandforget, 1),
+		'status': (commandstatus, 0),
+		}
+	command, wanted = commands.get(args[0], (None, -1))
+	if len(args) - 1 != wanted:
+		sys.stderr.write("usage: gcwconnect.py scan|list|connect <ssid>|forget <ssid>|status\n")
+		return 2
+	return command(*args[1:])
+
+def create_saved_networks_menu():
+	global uniq
+
+	uniq = NetworkList()
+	entries = savednetworks.refresh()
+	for confName in sorted(entries):
+		detail = dict(entries[confName])
+		del detail['mtime']
+		detail['Quality'] = '0/1'
+		uniq.append(detail)
 
 	if uniq:
-		l = []
-		for item in sorted(uniq.iterkeys(), key=lambda x: uniq[x]['menu']):
-			detail = uniq[item]
-			l.append([ detail['ESSID'], detail['Quality'], detail['Encryption'].upper()])
 		create_wireless_menu()
-		wirelessmenu.init(l, surface)
+		wirelessmenu.init([], surface)
+		wirelessmenu.set_networks(uniq)
 		wirelessmenu.draw()
 	else:
+		# Not the list of networks from the scan cache, which would still be
+		# there to pick from and forget
+		destroy_wireless_menu()
+		redraw()
 		text = 'empty'
-		renderedtext = font_huge.render(text, True, colors["lightbg"], colors["darkbg"])
+		renderedtext = textcache.render(font_huge, text, True, colors["lightbg"], colors["darkbg"])
 		textelement = renderedtext.get_rect()
 		textelement.left = 152
 		textelement.top = 96
-		surface.blit(renderedtext, textelement)
-		pygame.display.update()
+		compositor.invalidate(surface.blit(renderedtext, textelement))
+
+def forgetselected(button): # Closes the "Forget AP configuration?" dialog
+	global active_menu
+	if button == 'a':
+		savednetworks.remove(quote_plus(str(wirelessmenu.get_selected()[0]))+".conf")
+	create_saved_networks_menu()
+	redraw()
+	if len(uniq) < 1:
+		destroy_wireless_menu()
+		active_menu = to_menu("main")
+		redraw()
+
+def noresults():
+	text = ":("
+	renderedtext = textcache.render(font_huge, text, True, colors["lightbg"], colors["darkbg"])
+	textelement = renderedtext.get_rect()
+	textelement.left = 192
+	textelement.top = 96
+	compositor.invalidate(surface.blit(renderedtext, textelement))
+
+class LoopStats(object):
+	'''Counts how often the main loop wakes up and how often it pushes a frame
+	to the display, and reports both once a second on stderr, along with how
+	much text was rendered, how much of it the text cache served, and the
+	CommandStats of the tools run in that second. Enabled by setting
+	GCWCONNECT_MEASURE in the environment.
+	'''
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.since = time.time()
+		self.wakeups = 0
+		self.flushes = compositor.flushes
+		self.renders = LazyFont.renders
+		self.hits = textcache.hits
+		self.misses = textcache.misses
+		self.calls = dict((name, command.calls) for name, command in commandstats.items())
+
+	def report(self):
+		elapsed = time.time() - self.since
+		sys.stderr.write("wakeups/s: %.1f flips/s: %.1f renders/s: %.1f text cache hits: %s\n" % (
+			self.wakeups / elapsed, (compositor.flushes - self.flushes) / elapsed,
+			(LazyFont.renders - self.renders) / elapsed, textcache.hitrate(self.hits, self.misses)))
+		for name, command in sorted(commandstats.items()):
+			if command.calls != self.calls.get(name):
+				sys.stderr.write("%s: %s\n" % (name, command.describe()))
+		self.reset()
+
+class Hud(object):
+	'''A debug overlay over the status bar, toggled with the power switch. It
+	shows what the last frame that drew anything took: the time from the
+	event that started it to its last display update, how many display
+	updates, processes spawned and text renders it took, and how much of its
+	text the text cache served, and above that, how long the last scan and
+	connection attempt took. It only exists while it is shown,
+	and it draws itself once a frame has been measured, so it costs nothing
+	when it is off and doesn't count itself when it is on.
+	'''
+
+	def __init__(self):
+		self.begin()
+
+	def begin(self):  # An event has woken up the loop
+		self.started = time.time()
+		self.flushes = compositor.flushes
+		self.spawned = spawned
+		self.renders = LazyFont.renders
+		self.hits = textcache.hits
+		self.misses = textcache.misses
+
+	def end(self):  # The frame has been pushed to the display
+		if compositor.flushes == self.flushes:
+			return
+		lines = ["%.1fms %dupd %dproc %dtxt %s" % ((time.time() - self.started) * 1000,
+			compositor.flushes - self.flushes, spawned - self.spawned,
+			LazyFont.renders - self.renders, textcache.hitrate(self.hits, self.misses))]
+		# The durations go on a line of their own: both lines together don't
+		# fit across the screen
+		timings = ["%s %.1fs" % (name, durations[name])
+			for name in ('scan', 'connect') if name in durations]
+		if timings:
+			lines.insert(0, " ".join(timings))
+		top = screen_height - 16 - 14 * (len(lines) - 1)
+		area = pygame.draw.rect(surface, colors['black'], (0, top, screen_width, screen_height - top))
+		for i, text in enumerate(lines):
+			rendered = font_mono_small.render(text, True, colors['lightgrey'], colors['black'])
+			surface.blit(rendered, (2, top + 1 + 14 * i))
+		compositor.invalidate(area)
+		compositor.flush()
+
+hud = None
+
+def waitevent():
+	'''Pushes what has been drawn to the display, and sleeps until the next
+	event. Every loop that waits for input goes through here, so that the HUD
+	sees all of the frames.'''
+	compositor.flush()
+	if hud is not None:
+		hud.end()
+	event = pygame.event.wait()
+	if hud is not None:
+		hud.begin()
+	return event
 
 def convert_file_names():
 	"""In the directory containing WiFi network configuration files, removes
@@ -1476,6 +3131,26 @@ if __name__ == "__main__":
 	networks = {}
 	uniqssids = {}
 	active_menu = "main"
+	headless = '--headless' in sys.argv[1:]
+
+	if os.environ.get('GCWCONNECT_TRACE') or tracing:
+		starttracing(os.environ.get('GCWCONNECT_TRACE') or confdir + "trace.json")
+	if os.environ.get('GCWCONNECT_MEASURE'):
+		atexit.register(reportcommands)
+
+	if nodisplay:
+		# Whatever else gets printed, here or by the tools that are run, is a
+		# diagnostic: stdout is kept for JSON
+		jsonout = os.fdopen(os.dup(1), 'w')
+		os.dup2(2, 1)
+	else:
+		# Get the first frame on screen before anything else
+		initdisplay()
+		logoBar = LogoBar()
+		redraw()
+		compositor.flush()
+		if os.environ.get('GCWCONNECT_MEASURE'):
+			sys.stderr.write("first frame\n")
 
 	try:
 		createpaths()
@@ -1484,12 +3159,50 @@ if __name__ == "__main__":
 	else:
 		convert_file_names()
 
-	logoBar = LogoBar()
+	if headless:
+		sys.exit(0 if autojoinheadless() else 1)
+	if nodisplay:
+		sys.exit(runcommand(sys.argv[1:]))
 
-	redraw()
+	# Networks found by earlier scans can be browsed straight away
+	networks.update(scancache.load())
+	uniq = listuniqssids()
+	if uniq:
+		create_wireless_menu()
+		wirelessmenu.init([], surface)
+		wirelessmenu.set_networks(uniq)
+		to_menu("main")
+
+	stats = None
+	if os.environ.get('GCWCONNECT_MEASURE'):
+		stats = LoopStats()
+		pygame.time.set_timer(STATSEVENT, 1000)
+	pygame.time.set_timer(STATUSEVENT, 5000)
+
+	if autojoin or '--autojoin' in sys.argv[1:]:
+		startautojoin()
+
+	# Refresh the networks from the cache while they are shown, if the
+	# interface is there to scan with
+	if uniq and scanner is None and getoperstate(wlan) is not None:
+		try:
+			startscan(wlan, background=True)
+		except:
+			pass
+
+	if uniq or joiner is not None:
+		redraw()
 	while True:
-		time.sleep(0.01)
-		for event in pygame.event.get():
+		# Push the last frame and sleep until something happens, then handle
+		# everything that is pending before drawing the next one.
+		events = [waitevent()] + pygame.event.get()
+		if stats is not None:
+			stats.wakeups += 1
+
+		for event in events:
+			if handleoverlay(event):
+				continue
+
 			# GCW-Zero keycodes:
 			# A = K_LCTRL
 			# B = K_LALT
@@ -1503,34 +3216,105 @@ if __name__ == "__main__":
 			# power down = K_PAUSE
 
 			if event.type == QUIT:
+				cancelscan()
 				pygame.display.quit()
 				sys.exit()
 
-			elif event.type == KEYDOWN:
-				if event.key == K_PAUSE: # Power down
+			elif event.type == SCANEVENT or event.type == ANIMATEEVENT:
+				if scanner is None:
+					continue
+				scan = scanner
+				background = scanner.background
+				if pollscan() and (active_menu == "ssid" or wirelessmenu is not None and active_menu == "main"):
+					# Show networks as soon as they have been parsed. Rows
+					# that haven't changed are drawn from the menu's cache.
+					uniq = listuniqssids()
+					wirelessmenu.set_networks(uniq)
+					if background and overlay is None:
+						wirelessmenu.draw()
+					else:
+						redraw()
+				elif scanner is None:
+					if not background:
+						redraw()
+				elif not background:
+					drawscanprogress()
+				if scanner is None and active_menu == "ssid":
+					if len(uniq) < 1:
+						destroy_wireless_menu()
+						active_menu = to_menu("main")
+						redraw()
+						noresults()
+					else:
+						schedulescan()
+				if scanner is None and joiner is not None and joiner.candidates is None:
+					if scan.cancelled:
+						joiner = None
+					else:
+						joiner.candidates = autojoincandidates()
+						joinnext()
+
+			elif event.type == SCANTIMEREVENT:
+				unschedulescan()
+				if active_menu != "ssid" or scanner is not None:
 					pass
+				elif connector is not None or overlay is not None:
+					schedulescan()
+				else:
+					try:
+						startscan(wlan, background=True)
+					except:
+						schedulescan()
+
+			elif event.type == CONNECTEVENT:
+				if connector is not None:
+					pollconnect()
+
+			elif event.type == STATUSEVENT:
+				status = ifacestatus(wlan)
+				before = (status.up, status.ip, status.ssid)
+				invalidatestatus(wlan)
+				status = ifacestatus(wlan)
+				if before != (status.up, status.ip, status.ssid) and scanner is None:
+					redraw()
+
+			elif event.type == STATSEVENT:
+				stats.report()
+
+			elif event.type == KEYDOWN:
+				if event.key == K_PAUSE or event.key == K_KP0: # Power down/up
+					hud = Hud() if hud is None else None
+					redraw()
 				elif event.key == K_TAB: # Left shoulder button
 					pass
 				elif event.key == K_BACKSPACE: # Right shoulder button
 					pass
-				elif event.key == K_KP0:	# Power up
-					pass
 				elif event.key == K_UP: # Arrow up the menu
 					if active_menu == "main":
 						menu.draw(-1)
+						if wirelessmenu is not None:  # Cleared along with the menu
+							wirelessmenu.draw()
 					elif active_menu == "ssid" or active_menu == "saved":
 						wirelessmenu.draw(-1)
 				elif event.key == K_DOWN: # Arrow down the menu
 					if active_menu == "main":
 						menu.draw(1)
+						if wirelessmenu is not None:  # Cleared along with the menu
+							wirelessmenu.draw()
 					elif active_menu == "ssid" or active_menu == "saved":
 						wirelessmenu.draw(1)
 				elif event.key == K_RIGHT:
 					if wirelessmenu is not None and active_menu == "main":
 						active_menu = to_menu("ssid")
+						if scanner is None:
+							schedulescan()
 						redraw()
+				elif event.key == K_LALT and scanner is not None and not scanner.background:
+					cancelscan()
 				elif event.key == K_LALT or event.key == K_LEFT:
 					if active_menu == "ssid" or active_menu == "saved":
+						cancelscan()
+						unschedulescan()
 						destroy_wireless_menu()
 						active_menu = to_menu("main")
 						del uniq
@@ -1540,15 +3324,8 @@ if __name__ == "__main__":
 						sys.exit()
 				elif event.key == K_SPACE:
 					if active_menu == "saved":
-						confirm = modal("Forget AP configuration?", query=True)
-						if confirm:
-							os.remove(netconfdir+quote_plus(str(wirelessmenu.get_selected()[0]))+".conf")
-						create_saved_networks_menu()
-						redraw()
-						if len(uniq) < 1:
-							destroy_wireless_menu()
-							active_menu = to_menu("main")
-							redraw()
+						openoverlay(Modal("Forget AP configuration?",
+							[('a', 'Confirm'), ('b', 'Cancel')], onclose=forgetselected))
 				elif event.key == K_LCTRL or event.key == K_RETURN:
 					# Main menu
 					if active_menu == "main":
@@ -1556,49 +3333,21 @@ if __name__ == "__main__":
 							disconnect(wlan)
 							redraw()
 						elif menu.get_selected() == 'Scan for APs':
+							# Show what is known from earlier scans straight away;
+							# pollscan() merges in results as the scan runs.
+							uniq = listuniqssids()
+							create_wireless_menu()
+							wirelessmenu.init([], surface)
+							active_menu = to_menu("ssid")
 							try:
-								getnetworks(wlan)
-								uniq = listuniqssids()
+								startscan(wlan)
 							except:
-								uniq = {}
-								text = ":("
-								renderedtext = font_huge.render(text, True, colors["lightbg"], colors["darkbg"])
-								textelement = renderedtext.get_rect()
-								textelement.left = 192
-								textelement.top = 96
-								surface.blit(renderedtext, textelement)
-								pygame.display.update()
-
-							l = []
-							if len(uniq) < 1:
-								text = ":("
-								renderedtext = font_huge.render(text, True, colors["lightbg"], colors["darkbg"])
-								textelement = renderedtext.get_rect()
-								textelement.left = 192
-								textelement.top = 96
-								surface.blit(renderedtext, textelement)
-								pygame.display.update()
+								destroy_wireless_menu()
+								active_menu = to_menu("main")
+								redraw()
+								noresults()
 							else:
-								for item in sorted(uniq.iterkeys(), key=lambda x: uniq[x]['menu']):
-									for network, detail in uniq.iteritems():
-										if network == item:
-											try:
-												detail['Quality']
-											except KeyError:
-												detail['Quality'] = "0/1"
-											try:
-												detail['Encryption']
-											except KeyError:
-												detail['Encryption'] = ""
-
-											menuitem = [ detail['ESSID'], detail['Quality'], detail['Encryption']]
-											l.append(menuitem)
-
-								create_wireless_menu()
-								wirelessmenu.init(l, surface)
-								wirelessmenu.draw()
-
-								active_menu = to_menu("ssid")
+								wirelessmenu.set_networks(uniq)
 								redraw()
 						elif menu.get_selected() == 'Manual Setup':
 							ssid = ''
@@ -1662,108 +3411,100 @@ if __name__ == "__main__":
 					# SSID menu
 					elif active_menu == "ssid":
 						ssid = ""
-						for network, detail in uniq.iteritems():
-							position = str(wirelessmenu.get_position())
-							if str(detail['menu']) == position:
-								if detail['ESSID'].split("-")[0] == "gcwzero":
-									ssid = detail['ESSID']
-									conf = netconfdir + quote_plus(ssid) + ".conf"
-									encryption = "WPA2"
-									passphrase = ssid.split("-")[1]
-									connect(wlan)
-								else:
-									ssid = detail['ESSID']
-									conf = netconfdir + quote_plus(ssid) + ".conf"
-									encryption = detail['Encryption']
-									if not os.path.exists(conf):
-										if encryption == "none":
-											passphrase = "none"
-											encryption = "none"
-											writeconfig()
-											connect(wlan)
-										elif encryption == "WEP-40" or encryption == "WEP-128":
-											passphrase = ''
-											selected_key = ''
-											securitykey = ''
-											displayinputlabel("key")
-											drawkeyboard("wep")
-											encryption = "wep"
-											passphrase = getinput("wep", "key", ssid)
-										else:
-											passphrase = ''
-											selected_key = ''
-											securitykey = ''
-											displayinputlabel("key")
-											drawkeyboard("qwertyNormal")
-											passphrase = getinput("qwertyNormal", "key", ssid)
-									else:
+						detail = wirelessmenu.get_selected_network()
+						if detail is not None:
+							if detail['ESSID'].split("-")[0] == "gcwzero":
+								ssid = detail['ESSID']
+								conf = netconfdir + quote_plus(ssid) + ".conf"
+								encryption = "WPA2"
+								passphrase = ssid.split("-")[1]
+								connect(wlan)
+							else:
+								ssid = detail['ESSID']
+								conf = netconfdir + quote_plus(ssid) + ".conf"
+								encryption = detail['Encryption']
+								if not os.path.exists(conf):
+									if encryption == "none":
+										passphrase = "none"
+										encryption = "none"
+										writeconfig()
 										connect(wlan)
-								break
+									elif encryption == "WEP-40" or encryption == "WEP-128":
+										passphrase = ''
+										selected_key = ''
+										securitykey = ''
+										displayinputlabel("key")
+										drawkeyboard("wep")
+										encryption = "wep"
+										passphrase = getinput("wep", "key", ssid)
+									else:
+										passphrase = ''
+										selected_key = ''
+										securitykey = ''
+										displayinputlabel("key")
+										drawkeyboard("qwertyNormal")
+										passphrase = getinput("qwertyNormal", "key", ssid)
+								else:
+									connect(wlan)
 
 					# Saved Networks menu
 					elif active_menu == "saved":
 						ssid = ''
-						for network, detail in uniq.iteritems():
-							position = str(wirelessmenu.get_position()+1)
-							if str(detail['menu']) == position:
-								encryption = detail['Encryption']
-								ssid = str(detail['ESSID'])
-								shutil.copy2(netconfdir + quote_plus(ssid) + ".conf", sysconfdir+"config-"+wlan+".conf")
-								passphrase = detail['Key']
-								connect(wlan)
-								break
+						detail = wirelessmenu.get_selected_network()
+						if detail is not None:
+							encryption = detail['Encryption']
+							ssid = str(detail['ESSID'])
+							shutil.copy2(netconfdir + quote_plus(ssid) + ".conf", sysconfdir+"config-"+wlan+".conf")
+							passphrase = detail['Key']
+							connect(wlan)
 
 				elif event.key == K_ESCAPE:
 					if active_menu == "ssid": # Allow us to edit the existing key
 						ssid = ""
-						for network, detail in uniq.iteritems():
-							position = str(wirelessmenu.get_position())
-							if str(detail['menu']) == position:
-								ssid = network
-								encryption = detail['Encryption']
-								if detail['Encryption'] == "none":
-									pass
-								elif detail['Encryption'] == "wep":
-									passphrase = ''
-									selected_key = ''
-									securitykey = ''
-									displayinputlabel("key")
-									drawkeyboard("wep")
-									getinput("wep", "key", ssid)
-								else:
-									passphrase = ''
-									selected_key = ''
-									securitykey = ''
-									displayinputlabel("key")
-									drawkeyboard("qwertyNormal")
-									getinput("qwertyNormal", "key", ssid)
+						detail = wirelessmenu.get_selected_network()
+						if detail is not None:
+							ssid = detail['ESSID']
+							encryption = detail['Encryption']
+							if detail['Encryption'] == "none":
+								pass
+							elif detail['Encryption'] == "wep":
+								passphrase = ''
+								selected_key = ''
+								securitykey = ''
+								displayinputlabel("key")
+								drawkeyboard("wep")
+								getinput("wep", "key", ssid)
+							else:
+								passphrase = ''
+								selected_key = ''
+								securitykey = ''
+								displayinputlabel("key")
+								drawkeyboard("qwertyNormal")
+								getinput("qwertyNormal", "key", ssid)
 
 					if active_menu == "saved": # Allow us to edit the existing key
 						ssid = ''
 
-						for network, detail in uniq.iteritems():
-							position = str(wirelessmenu.get_position()+1)
-							if str(detail['menu']) == position:
-								ssid = network
-								passphrase = uniq[network]['Key']
-								encryption = uniq[network]['Encryption'].upper()
-								if uniq[network]['Encryption'] == "none":
-									pass
-								elif uniq[network]['Encryption'] == "wep":
-									passphrase = ''
-									selected_key = ''
-									securitykey = ''
-									encryption = "WEP-40"
-									displayinputlabel("key")
-									drawkeyboard("wep")
-									getinput("wep", "key", ssid)
-								else:
-									passphrase = ''
-									selected_key = ''
-									securitykey = ''
-									displayinputlabel("key")
-									drawkeyboard("qwertyNormal")
-									getinput("qwertyNormal", "key", ssid)
-
+						detail = wirelessmenu.get_selected_network()
+						if detail is not None:
+							ssid = detail['ESSID']
+							passphrase = detail['Key']
+							encryption = detail['Encryption'].upper()
+							if detail['Encryption'] == "none":
+								pass
+							elif detail['Encryption'] == "wep":
+								passphrase = ''
+								selected_key = ''
+								securitykey = ''
+								encryption = "WEP-40"
+								displayinputlabel("key")
+								drawkeyboard("wep")
+								getinput("wep", "key", ssid)
+							else:
+								passphrase = ''
+								selected_key = ''
+								securitykey = ''
+								displayinputlabel("key")
+								drawkeyboard("qwertyNormal")
+								getinput("qwertyNormal", "key", ssid)
 
-		pygame.display.update()
@@ -0,0 +1,62 @@
+#	test_ifacequery.py
+#
+#	Tests the kernel queries for the IPv4 address, ESSID, link state and MAC
+#	address of an interface, against the loopback interface and a fake sysfs
+#	tree with a wireless interface that is up and one that is down.
+#
+#	Usage: python -m unittest discover tests
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.dont_write_bytecode = True
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import gcwconnect
+
+
+class KernelQueryTest(unittest.TestCase):
+
+	def setUp(self):
+		self.sysfsdir = gcwconnect.sysfsdir
+		self.tree = tempfile.mkdtemp()
+		for iface, mac, operstate in (
+				('wlan0', '02:00:00:00:00:01', 'up'),
+				('wlan1', '02:00:00:00:00:02', 'down')):
+			os.mkdir(os.path.join(self.tree, iface))
+			with open(os.path.join(self.tree, iface, 'address'), 'w') as f:
+				f.write(mac + '\n')
+			with open(os.path.join(self.tree, iface, 'operstate'), 'w') as f:
+				f.write(operstate + '\n')
+		gcwconnect.sysfsdir = self.tree + '/'
+
+	def tearDown(self):
+		gcwconnect.sysfsdir = self.sysfsdir
+		shutil.rmtree(self.tree)
+
+	def test_getip(self):
+		self.assertEqual(gcwconnect.getip('lo'), '127.0.0.1')
+		self.assertIsNone(gcwconnect.getip('nonexistent0'))
+
+	def test_getessid(self):
+		self.assertIsNone(gcwconnect.getessid('lo'))  # Not a wireless interface
+		self.assertIsNone(gcwconnect.getessid('nonexistent0'))
+
+	def test_getoperstate(self):
+		self.assertEqual(gcwconnect.getoperstate('wlan0'), 'up')
+		self.assertEqual(gcwconnect.getoperstate('wlan1'), 'down')
+		self.assertIsNone(gcwconnect.getoperstate('nonexistent0'))
+
+	def test_getmac(self):
+		self.assertEqual(gcwconnect.getmac('wlan0'), '02:00:00:00:00:01')
+		self.assertIsNone(gcwconnect.getmac('nonexistent0'))
+
+
+if __name__ == "__main__":
+	unittest.main()